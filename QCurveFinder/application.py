@@ -1,19 +1,27 @@
 from PyQt5.QtWidgets import QApplication, QWidget, QHBoxLayout, QVBoxLayout, QPushButton, \
-    QFileDialog, QMessageBox, QFrame
+    QFileDialog, QMessageBox, QFrame, QInputDialog
 from PyQt5.QtGui import QIcon, QPalette, QColor
 from PyQt5.QtCore import Qt
 
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
-
 from .widgets import QImage, QInstructBox, QCoordOption, QContoursOption, QColorsOption, QFilterOption,\
     QEdgeSelectionOption, QEvaluationOptions
-from .tools import get_copy_text, CurveFinder
+from .tools import CurveFinder, PointSet
+from .pipeline import ImagePipeline, display_image, fit_size, read_image
+from .engine import FilterSpec, rotate_image, filter_preview, draw_selection, plot_area, roi_bounds, parse_roi, \
+    format_roi
+from .fitting import FitEngine
+from .models import FitModel, PolynomialModel
+from .export import export_arrays, export_curve
+from .cache import FilterCache, DiskCache
+from .tiles import TiledProcessor
+from .workers import QFilterPreviewWorker
+from .plotview import PlotView
+from .selection import SelectionMask
+from .session import Session, file_hash
+from .templates import CalibrationTemplate, list_templates
 from .constants import *
 
-from typing import List, Tuple
-from random import randrange
-from shutil import rmtree
+from typing import Callable, Dict, List, Optional, Tuple
 import numpy as np
 import darkdetect
 import cv2
@@ -30,16 +38,29 @@ class QCurveFinder(QWidget):
         # Set class variables
         self.curvefinder: CurveFinder
         self.img_src: str = PH_IMAGE_PATH
+        self.image_hash: str = ""
+        self.pipeline: ImagePipeline = ImagePipeline()
         self.coord: np.ndarray = np.zeros(4, dtype=float)
-        self.pts_final_p: List[np.ndarray] = []
-        self.pts_final_r: List[np.ndarray] = []
-        self.pts_eval_r: List[np.ndarray] = []
-        self.pts_coord: List[Tuple[int, int]] = [(-1, -1)]*4
+        self.pts_final: PointSet = PointSet(np.empty((0, 2)), np.empty((0, 2)))
+        self.pts_fit: PointSet = self.pts_final  # Reduced points used by the fit, the plot and the copy
+        self.pts_eval: PointSet = PointSet(np.empty((0, 2)))
+        self.fit_engine: FitEngine = FitEngine(self.pts_fit)
+        self.remapped: Dict[Tuple[bool, bool], PointSet] = {}  # Points of each lin/log axis, by (x_is_lin, y_is_lin)
+        self.fit_engines: Dict[Tuple[bool, bool], FitEngine] = {}  # Fits of the reduced points of each lin/log axis
+        self.pts_coord: List[Tuple[float, float]] = [(-1, -1)]*4
         self.coef: list = []
+        self.model: FitModel = PolynomialModel([], 0, 0)
         self.order: int = 5
         self.var: str = "x"
         self.islog: List[bool] = [False, False]
-        self.mask: np.ndarray = None
+        self.selection: SelectionMask = None
+        self.filter_cache: FilterCache = None
+        self.disk_cache: DiskCache = DiskCache()
+        self.rotation_key: tuple = ()
+        self.tiles: Optional[TiledProcessor] = None
+        self.roi: Optional[list] = None
+        self.entered_roi: Optional[list] = None  # Region entered instead of the plot area
+        self.spec: Optional[FilterSpec] = None
         self.isEquationReady: bool = False
 
         self.setWindowTitle(f"CurveFinder v{VER}")
@@ -47,12 +68,6 @@ class QCurveFinder(QWidget):
         self.setBaseSize(APP_WIDTH, APP_HEIGHT)
         self.setMinimumSize(APP_WIDTH, APP_HEIGHT)
 
-        # Create a temporary and data folder
-        if not os.path.exists(RESOURCES_PATH):
-            os.mkdir(RESOURCES_PATH)
-        if not os.path.exists(TEMP_PATH):
-            os.mkdir(TEMP_PATH)
-
         # Create widgets
         self.img: QImage = QImage(PH_IMAGE_PATH)
         self.instruct: QInstructBox = QInstructBox()
@@ -60,13 +75,25 @@ class QCurveFinder(QWidget):
         self.but_browse: QPushButton = QPushButton(text="Select an image")
         self.but_start: QPushButton = QPushButton(text="Start")
         self.but_next: QPushButton = QPushButton(text="Next")
+        self.but_open_session: QPushButton = QPushButton(text="Open session")
+        self.but_save_session: QPushButton = QPushButton(text="Save session")
+        self.but_save_template: QPushButton = QPushButton(text="Save template")
+        self.but_save_image: QPushButton = QPushButton(text="Save image")
         self.current_layout = None
+        self.preview_worker: QFilterPreviewWorker = QFilterPreviewWorker()
+        self.plot_view: PlotView = PlotView()
 
         # Bind the signals
+        self.preview_worker.ready.connect(self.show_filter_preview)
+        self.preview_worker.error.connect(self.show_filter_error)
         self.img.signal.connect(self.add_position)
         self.but_browse.clicked.connect(self.browse_for_image)
         self.but_start.clicked.connect(self.start)
         self.but_next.clicked.connect(self.next)
+        self.but_open_session.clicked.connect(self.open_session)
+        self.but_save_session.clicked.connect(self.save_session)
+        self.but_save_template.clicked.connect(self.save_template)
+        self.but_save_image.clicked.connect(self.save_image)
 
         # Set application state
         self.app_state = AppState.INITIAL
@@ -76,10 +103,6 @@ class QCurveFinder(QWidget):
 
         self.show()
 
-    def __del__(self) -> None:
-        """ Remove the temporary folder """
-        rmtree(TEMP_PATH)
-
     def set_layout(self) -> None:
         # Set the palette
         if darkdetect.isDark():
@@ -118,7 +141,14 @@ class QCurveFinder(QWidget):
         hrule.setFrameShape(QFrame.HLine)
         hrule.setFrameShadow(QFrame.Sunken)
         browse_lay.addWidget(hrule)
+        session_lay = QHBoxLayout()
+        session_lay.addWidget(self.but_open_session)
+        session_lay.addWidget(self.but_save_session)
+        session_lay.addWidget(self.but_save_template)
+        session_lay.addWidget(self.but_save_image)
+
         browse_lay.addWidget(self.but_browse)
+        browse_lay.addLayout(session_lay)
         browse_lay.addLayout(but_lay)
 
         side_lay = QVBoxLayout()
@@ -154,6 +184,9 @@ class QCurveFinder(QWidget):
 
         elif new_state == AppState.STARTED:
             self.current_layout = QCoordOption()
+            self.current_layout.template.addItems(list_templates())
+            self.current_layout.but_apply_template.setEnabled(self.current_layout.template.count() > 0)
+            self.current_layout.but_apply_template.clicked.connect(self.apply_template)
 
         elif new_state == AppState.FILTER_CHOICE:
             self.current_layout = QFilterOption()
@@ -163,6 +196,8 @@ class QCurveFinder(QWidget):
             self.current_layout.contours.slider2.sliderMoved.connect(self.update_image)
             self.current_layout.colors.color_changed.connect(self.update_image)
             self.current_layout.colors.slider.sliderMoved.connect(self.update_image)
+            self.current_layout.plot_area.toggled.connect(self.update_image)
+            self.current_layout.roi.editingFinished.connect(self.check_roi)
 
         elif new_state == AppState.EDGE_SELECTION:
             self.current_layout = QEdgeSelectionOption()
@@ -171,7 +206,14 @@ class QCurveFinder(QWidget):
         elif new_state == AppState.EQUATION_IMAGE:
             self.current_layout = QEvaluationOptions()
             self.current_layout.but_copy.clicked.connect(self.copy_text)
+            self.current_layout.but_save.clicked.connect(self.save_text)
+            self.current_layout.but_export.clicked.connect(self.export_binary)
             self.current_layout.spinbox.valueChanged.connect(self.set_equation)
+            self.current_layout.auto_order.toggled.connect(self.set_equation)
+            self.current_layout.model.currentIndexChanged.connect(self.set_equation)
+            self.current_layout.aggregation.currentIndexChanged.connect(self.set_equation)
+            self.current_layout.bin_width.valueChanged.connect(self.set_equation)
+            self.current_layout.epsilon.valueChanged.connect(self.set_equation)
             self.current_layout.y_from_x.toggled.connect(self.set_equation)
             self.current_layout.x_from_y.toggled.connect(self.set_equation)
             self.current_layout.x_lin.toggled.connect(self.update_lin_log)
@@ -185,7 +227,7 @@ class QCurveFinder(QWidget):
 
     def browse_for_image(self) -> None:
         """ Method to select an image """
-        src = str(QFileDialog().getOpenFileName(filter="Images (*.png *.bmp *.jpg)")[0])
+        src = str(QFileDialog().getOpenFileName(filter=IMAGE_FILTER)[0])
         if src != "":
             self.img_src = src
             self.img.source = self.img_src
@@ -193,9 +235,10 @@ class QCurveFinder(QWidget):
 
     def start(self) -> None:
         """ Method for the Start button """
-        with open(self.img_src, "rb") as stream:
-            img = cv2.imdecode(np.asarray(bytearray(stream.read()), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
-        cv2.imwrite(ORIG_IMG, img)
+        src = self.img_src
+        self.image_hash = file_hash(src)
+        self.pipeline.load(self.disk_cache.get((self.image_hash, ImageStage.ORIGINAL),
+                                               lambda: {ImageStage.ORIGINAL: read_image(src)})[ImageStage.ORIGINAL])
         self.app_state = AppState.STARTED
 
     def next(self) -> None:
@@ -203,6 +246,7 @@ class QCurveFinder(QWidget):
         if self.app_state == AppState.COORD_ALL_SELECTED and self.verify_coord():
             self.app_state = AppState.FILTER_CHOICE
         elif self.app_state == AppState.FILTER_CHOICE:
+            self.apply_filter()
             self.app_state = AppState.EDGE_SELECTION
         elif self.app_state == AppState.EDGE_SELECTION:
             self.app_state = AppState.EQUATION_IMAGE
@@ -231,7 +275,9 @@ class QCurveFinder(QWidget):
         return good_coord
 
     def add_position(self, x: int, y: int, button: Qt.MouseButton) -> None:
-        """ Method used when clicking with the mouse on the image """
+        """ Method used when clicking with the mouse on the image, (x, y) being in the display coordinates """
+        x, y = self.pipeline.transform.to_image(x, y)  # Work in full resolution
+
         if self.app_state == AppState.STARTED:
             if not self.current_layout.x1_done:
                 self.current_layout.pts[0] = (x, y)
@@ -249,23 +295,27 @@ class QCurveFinder(QWidget):
 
         elif self.app_state == AppState.EDGE_SELECTION:
             if button == Qt.MouseButton.LeftButton:
-                self.draw_mask(x, y, 255)
+                self.draw_mask(x, y, True)
             elif button == Qt.MouseButton.RightButton:
-                self.draw_mask(x, y, 1)
+                self.draw_mask(x, y, False)
 
-    def draw_mask(self, x: int, y: int, color: int) -> None:
+    def draw_mask(self, x: float, y: float, selected: bool) -> None:
         """ Method to draw the brush on the image """
-        radius = self.current_layout.spinbox.value()
-        cv2.circle(self.mask, (x, y), radius, color, -1)
+        radius = self.current_layout.spinbox.value()/self.pipeline.transform.scale  # The brush is sized on the display
+        self.selection.paint(round(x), round(y), round(radius), selected)
 
     def resize_and_rotate(self) -> None:  # TODO: Dewarp the image
         """ Method to rotate the image after the coordinate are confirmed. """
-        img = cv2.imread(self.img_src)
-        rot_matrix = self.curvefinder.get_rotation_matrix()
-        img = cv2.warpAffine(img, rot_matrix, img.shape[1::-1], flags=cv2.INTER_LINEAR)
+        original, curvefinder = self.pipeline[ImageStage.ORIGINAL], self.curvefinder
+
+        def rotate() -> Dict[ImageStage, np.ndarray]:
+            img = rotate_image(original, curvefinder)
+            return {ImageStage.ROTATED: img, ImageStage.GRAY: cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)}
 
-        cv2.imwrite(ROTA_IMG, img)
-        self.img.source = ROTA_IMG
+        matrix = curvefinder.get_rotation_matrix()
+        self.rotation_key = (self.image_hash, ImageStage.ROTATED, tuple(np.round(matrix, 9).ravel().tolist()))
+        self.pipeline.update(self.disk_cache.get(self.rotation_key, rotate))
+        self.img.source = self.pipeline.display(ImageStage.ROTATED)
 
     def update_lin_log(self):
         """
@@ -274,175 +324,383 @@ class QCurveFinder(QWidget):
         """
         ready_to_update = self.app_state >= AppState.FILTER_CHOICE
         if ready_to_update:
-            self.curvefinder.update_lin_log(self.current_layout.x_lin.isChecked(),
-                                            self.current_layout.y_lin.isChecked(),
-                                            ready_to_update)
+            key = (self.current_layout.x_lin.isChecked(), self.current_layout.y_lin.isChecked())
+            self.curvefinder.update_lin_log(*key, ready_to_update)
+            if key not in self.remapped:  # Flipping back to a scale reuses its points, their reductions and fits
+                self.remapped[key] = self.pts_final.remap(self.curvefinder)
+            self.pts_final = self.remapped[key]
             self.set_equation()
 
     def set_equation(self, do: bool = True) -> None:
         """ Method to update the equation displayed in the instruction box """
         if do and self.app_state >= AppState.EQUATION_IMAGE:
-            if self.current_layout.x_lin.isChecked():
-                x = np.array(self.pts_final_r)[:, 0]
-                x_log = False
-            else:
-                x = np.log10(self.pts_final_r)[:, 0]
-                x_log = True
-            if self.current_layout.y_lin.isChecked():
-                y = np.array(self.pts_final_r)[:, 1]
-                y_log = False
+            x_log = not self.current_layout.x_lin.isChecked()
+            y_log = not self.current_layout.y_lin.isChecked()
+            y_from_x = self.current_layout.y_from_x.isChecked()
+
+            self.var = "x" if y_from_x else "y"
+            self.islog = [x_log, y_log] if y_from_x else [y_log, x_log]
+            self.pts_fit = self.pts_final.reduce(self.current_layout.aggregation.currentIndex(),
+                                                 self.current_layout.bin_width.value(),
+                                                 self.current_layout.epsilon.value(), y_from_x, x_log, y_log)
+            engine = self.fit_engines.get((not x_log, not y_log))
+            if engine is None or engine.points is not self.pts_fit:  # The factorizations and fits are kept
+                engine = self.fit_engines[(not x_log, not y_log)] = FitEngine(self.pts_fit)
+            self.fit_engine = engine
+
+            model_type = ModelType(self.current_layout.model.currentIndex())
+            polynomial = model_type in POLYNOMIAL_MODELS
+            self.current_layout.auto_order.setEnabled(polynomial)
+            self.current_layout.spinbox.setEnabled(polynomial and not self.current_layout.auto_order.isChecked())
+
+            order_text = ""
+            if polynomial and self.current_layout.auto_order.isChecked():
+                self.order, scores = self.fit_engine.select_order(OrderCriterion.CROSS_VALIDATION, y_from_x, x_log,
+                                                                  y_log)
+                self.current_layout.spinbox.blockSignals(True)  # Already fitted with this order
+                self.current_layout.spinbox.setValue(self.order)
+                self.current_layout.spinbox.blockSignals(False)
+                order_text = f"The order {self.order} was chosen by a {FIT_CV_FOLDS}-fold cross-validation, " \
+                             "the RMSE of each order being :\n\n" + \
+                             ", ".join(f"{o} : {e:0.2e}" for o, e in enumerate(scores)) + "\n\n"
             else:
-                y = np.log10(self.pts_final_r)[:, 1]
-                y_log = True
-
-            if self.current_layout.y_from_x.isChecked():
-                var = "x"
-                a = x
-                b = y
-                a_log = x_log
-                b_log = y_log
-            else:
-                var = "y"
-                a = y
-                b = x
-                a_log = y_log
-                b_log = x_log
-
-            self.var = var
-            self.islog = [a_log, b_log]
-            self.order = order = self.current_layout.spinbox.value()
-            self.coef = coef = np.polyfit(a, b, order)
-            b = np.poly1d(coef)
-            eval_a = np.linspace(min(a), max(a), 100)
-            eval_b = b(eval_a)
-
-            if a_log:
-                eval_a = np.power(10, eval_a)
-            if b_log:
-                eval_b = np.power(10, eval_b)
-
-            if var == "x":
-                ex = eval_a
-                ey = eval_b
-            else:
-                ex = eval_b
-                ey = eval_a
-
-            eval_pts = []
-            for (x, y) in zip(ex, ey):
-                eval_pts.append(np.array([x, y]))
-
-            self.pts_eval_r = eval_pts
+                self.order = self.current_layout.spinbox.value()
+            self.model = self.fit_engine.model(model_type, self.order, y_from_x, x_log, y_log)
+            self.coef, self.pts_eval = self.model.coefs, self.model.eval_points()
 
-            equation = get_copy_text(CopyOptions.EQUATION_MARKDOWN, self.var, self.coef, self.pts_final_r)
+            equation = self.model.copy_text(CopyOptions.EQUATION_MARKDOWN, self.var, self.pts_fit)
 
             text = "The equation for this curve is :\n\n" \
                    f"{equation}\n\n" \
+                   f"{order_text}" \
                    "For more precision, use the copy function below."
             self.instruct.textbox.setMarkdown(text)
 
             if self.app_state == AppState.EQUATION_PLOT:
                 self.plot_points()
 
-    def update_image(self) -> None:
-        """ Method to update the image with the contour chosen in the combobox """
-        if self.app_state == AppState.FILTER_CHOICE:
-            if self.current_layout.tabs.currentIndex() == 0:  # On contour tab
-                img = cv2.cvtColor(cv2.imread(ROTA_IMG), cv2.COLOR_BGR2GRAY)
-                tr1, tr2 = [self.current_layout.contours.slider1.value(), self.current_layout.contours.slider2.value()]
+    def filter_spec(self) -> FilterSpec:
+        """ Method to get the filter chosen in the filter options """
+        contours = self.current_layout.contours
+        color = self.current_layout.colors.color
+        return FilterSpec(self.current_layout.tabs.currentIndex(), contours.combo.currentIndex(),
+                          contours.slider1.value(), contours.slider2.value(),
+                          (color.red(), color.green(), color.blue()), self.current_layout.colors.slider.value())
+
+    def layout_roi(self) -> Optional[list]:
+        """ Method to get the region entered in the filter options, None if empty or invalid """
+        try:
+            return parse_roi(self.current_layout.roi.text())
+        except ValueError:  # Warned about by check_roi
+            return None
+
+    def filter_roi(self) -> Optional[list]:
+        """ Method to get the region filtered, the region entered, the plot area or the whole image """
+        roi = self.layout_roi()
+        if roi is not None:
+            return roi
+        return plot_area(self.curvefinder) if self.current_layout.plot_area.isChecked() else None
+
+    def check_roi(self) -> None:
+        """ Method to check the region entered, clear it if invalid, and update the preview """
+        try:
+            parse_roi(self.current_layout.roi.text())
+        except ValueError as error:
+            self.current_layout.roi.clear()
+            msgBox = QMessageBox()
+            msgBox.setIcon(QMessageBox.Warning)
+            msgBox.setText(f"{error}")
+            msgBox.setWindowTitle("Warning")
+            msgBox.setStandardButtons(QMessageBox.Ok)
+            msgBox.exec()
+        self.current_layout.plot_area.setEnabled(not self.current_layout.roi.text())
+        self.update_image()
+
+    @staticmethod
+    def filter_key(spec: FilterSpec, roi: Optional[list]) -> tuple:
+        """ Method to get the cache key of a filter preview """
+        if roi is None:
+            return spec.key() + (None,)
+        return spec.key() + (tuple(tuple(pt) for pt in roi) if np.ndim(roi) == 2 else tuple(roi),)
 
-                mode = self.current_layout.contours.combo.currentIndex()
+    def update_image(self) -> None:
+        """
+        Method to update the image with the filter chosen in the filter options.
 
-                if mode == ContourOptions.CANNY:
-                    img = cv2.Canny(img, tr1, tr2)
+        Cached previews are shown right away, the others are computed by the preview worker.
+        """
+        if self.app_state == AppState.FILTER_CHOICE:
+            spec, roi = self.filter_spec(), self.filter_roi()
+            key = self.filter_key(spec, roi)
+            if key in self.filter_cache:
+                self.preview_worker.cancel()
+                self.show_filter_preview(key, self.filter_cache[key])
+            else:
+                self.preview_worker.request(key, self.filter_task(spec, roi))
 
-                elif mode == ContourOptions.GLOBAL:
-                    img = cv2.medianBlur(img, 5)
-                    ret, img = cv2.threshold(img, tr1, tr2, cv2.THRESH_BINARY)
+    def filter_task(self, spec: FilterSpec, roi: Optional[List[int]]) -> Callable[[], Dict[ImageStage, np.ndarray]]:
+        """
+        Method to get the computation of a filter result, read from the disk cache if there, for any thread.
 
-                elif mode == ContourOptions.ADAPTIVE_MEAN:
-                    img = cv2.medianBlur(img, 5)
-                    img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 11, 2)
+        The previews are only kept in memory, the applied filter being the only one saved to the disk cache.
+        """
+        img, gray, tiles, disk_cache = self.filter_cache.image, self.filter_cache.gray, self.tiles, self.disk_cache
+        key = self.rotation_key + self.filter_key(spec, roi)
+        return lambda: disk_cache.load(key) or filter_preview(img, gray, spec, tiles, roi)
 
-                elif mode == ContourOptions.ADAPTIVE_GAUSSIAN:
-                    img = cv2.medianBlur(img, 5)
-                    img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    def show_filter_preview(self, key: tuple, result: dict) -> None:
+        """ Method to display a filter preview once it is computed """
+        if self.app_state == AppState.FILTER_CHOICE:
+            self.filter_cache.put(key, result)
+            self.pipeline.update(result)
+            self.img.source = self.pipeline.display(ImageStage.COLORED if key[0] == FilterMode.COLORS
+                                                    else ImageStage.CONTOURED)
+
+    def show_filter_error(self, key: tuple, error: Exception) -> None:
+        """ Method to warn that a filter preview failed, the previous preview staying displayed """
+        msgBox = QMessageBox()
+        msgBox.setIcon(QMessageBox.Warning)
+        msgBox.setText(f"The filter preview failed: {error}")
+        msgBox.setWindowTitle("Warning")
+        msgBox.setStandardButtons(QMessageBox.Ok)
+        msgBox.exec()
+
+    def apply_filter(self) -> None:
+        """ Method to compute the filter chosen, without the preview worker, before leaving the filter choice """
+        self.preview_worker.cancel()
+        spec, self.roi, self.entered_roi = self.filter_spec(), self.filter_roi(), self.layout_roi()
+        self.spec = spec
+        key = self.filter_key(spec, self.roi)
+        result = self.filter_cache.get(key, self.filter_task(spec, self.roi))
+        if self.rotation_key + key not in self.disk_cache:
+            self.disk_cache.save(self.rotation_key + key, result)
+        self.pipeline.update(result)
 
-                elif mode == ContourOptions.OTSUS:
-                    ret, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+    def plot_points(self) -> None:
+        """ Method to update the plot and display it """
+        self.img.source = self.plot_view.update(self.pts_fit, self.pts_eval, not self.current_layout.x_lin.isChecked(),
+                                                not self.current_layout.y_lin.isChecked())
 
-                elif mode == ContourOptions.OTSUS_GAUSSIAN_BLUR:
-                    img = cv2.GaussianBlur(img, (5, 5), 0)
-                    ret, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+    def copy_text(self) -> None:
+        """ Method to copy certain data """
+        text = "".join(self.model.iter_text(self.current_layout.combo.currentIndex(), self.var, self.pts_fit))
 
-                else:
-                    pass
+        if text:
+            QApplication.clipboard().setText(text)
 
-                cont, h = cv2.findContours(img, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
-                a, b = img.shape
-                img = np.zeros((a, b, 3))
+    def save_text(self) -> None:
+        """ Method to save certain data to a file instead of the clipboard """
+        mode = self.current_layout.combo.currentIndex()
+        dst = str(QFileDialog().getSaveFileName(filter=COPY_OPTIONS_FILTER[mode])[0])
+        if dst != "":
+            with open(dst, "w", encoding="utf-8", newline="") as stream:
+                stream.writelines(self.model.iter_text(mode, self.var, self.pts_fit))
+
+    def export_binary(self) -> None:
+        """ Method to export the points, the evaluated curve, the model and the calibration to a binary file """
+        option = self.current_layout.export_combo.currentIndex()
+        dst = str(QFileDialog().getSaveFileName(filter=EXPORT_OPTIONS_FILTER[option])[0])
+        if dst != "":
+            metadata = {**self.curvefinder.to_dict(), "var": self.var, **self.model.to_dict()}
+            try:
+                export_curve(dst, option, export_arrays(self.pts_fit, self.model, self.pts_eval), metadata)
+            except RuntimeError as e:  # The library of the format is not installed
+                msgBox = QMessageBox()
+                msgBox.setIcon(QMessageBox.Warning)
+                msgBox.setText(str(e))
+                msgBox.setWindowTitle("Warning")
+                msgBox.setStandardButtons(QMessageBox.Ok)
+                msgBox.exec()
 
-                for c in cont:
-                    col = (randrange(255), randrange(255), randrange(255))
-                    cv2.drawContours(img, c, -1, col)
+    def evaluate(self) -> None:
+        value = self.model(float(self.current_layout.input.text()))
+        self.current_layout.output.setText(f"{value:0.3f}")
 
-                cv2.imwrite(CONT_IMG, img)
-                self.img.source = CONT_IMG
-            elif self.current_layout.tabs.currentIndex() == 1:  # On the colors tab
-                img = cv2.imread(ROTA_IMG)
-                color = self.current_layout.colors.color
-                thresh = self.current_layout.colors.slider.value()
+    def session(self) -> Session:
+        """ Method to get the session of the manual steps done so far """
+        state = min(self.app_state, AppState.EQUATION_IMAGE)
+        session = Session(os.path.abspath(self.img_src), self.image_hash, state, self.curvefinder.to_dict())
+        if state == AppState.FILTER_CHOICE:
+            session.spec, session.plot_area = self.filter_spec(), self.current_layout.plot_area.isChecked()
+            session.roi = self.layout_roi()
+        elif state >= AppState.EDGE_SELECTION:
+            session.spec, session.plot_area, session.roi = self.spec, self.roi is not None, self.entered_roi
+            session.selection = self.selection.selected
+
+        if state == AppState.EQUATION_IMAGE:
+            layout = self.current_layout
+            session.evaluation = {"model": ModelType(layout.model.currentIndex()).name.lower(),
+                                  "order": layout.spinbox.value(), "auto_order": layout.auto_order.isChecked(),
+                                  "aggregation": Aggregation(layout.aggregation.currentIndex()).name.lower(),
+                                  "bin_width": layout.bin_width.value(), "epsilon": layout.epsilon.value(),
+                                  "y_from_x": layout.y_from_x.isChecked()}
+        return session
+
+    def save_session(self) -> None:
+        """ Method to save the session to a file """
+        dst = str(QFileDialog().getSaveFileName(filter=SESSION_FILTER)[0])
+        if dst != "":
+            self.session().save(dst)
+
+    def shown_stage(self) -> ImageStage:
+        """ Method to get the stage of the image of the current step """
+        if self.app_state >= AppState.EQUATION_IMAGE:
+            return ImageStage.SELECTED
+        spec = self.filter_spec() if self.app_state == AppState.FILTER_CHOICE else self.spec
+        stage = ImageStage.COLORED if spec.mode == FilterMode.COLORS else ImageStage.CONTOURED
+        return stage if stage in self.pipeline else ImageStage.ROTATED  # The first preview is not ready yet
+
+    def save_image(self) -> None:
+        """ Method to save the image of the current step in full resolution """
+        dst = str(QFileDialog().getSaveFileName(filter=IMAGE_FILTER)[0])
+        if dst == "":
+            return
 
-                # Define the range
-                lower = np.array([color.blue() - thresh, color.green() - thresh, color.red() - thresh]).clip(0, 255)
-                upper = np.array([color.blue() + thresh, color.green() + thresh, color.red() + thresh]).clip(0, 255)
+        try:
+            self.pipeline.export(self.shown_stage(), dst)
+        except (ValueError, OSError, cv2.error) as error:
+            msgBox = QMessageBox()
+            msgBox.setIcon(QMessageBox.Warning)
+            msgBox.setText(f"The image could not be saved: {error}")
+            msgBox.setWindowTitle("Warning")
+            msgBox.setStandardButtons(QMessageBox.Ok)
+            msgBox.exec()
+
+    def open_session(self) -> None:
+        """ Method to open a session file and resume it where it was saved """
+        src = str(QFileDialog().getOpenFileName(filter=SESSION_FILTER)[0])
+        if src == "":
+            return
 
-                # find the mask
-                mask = cv2.inRange(img, lower, upper)
-                img = cv2.addWeighted(cv2.bitwise_and(img, img, mask=mask), 0.5, img, 0.5, 0)
+        session = Session.load(src)
+        img_src = session.find_image(src)
+        if img_src is None:
+            msgBox = QMessageBox()
+            msgBox.setIcon(QMessageBox.Warning)
+            msgBox.setText(f"The image {os.path.basename(session.image)} of the session was not found or has changed!")
+            msgBox.setWindowTitle("Warning")
+            msgBox.setStandardButtons(QMessageBox.Ok)
+            msgBox.exec()
+            return
 
-                cv2.imwrite(COLO_IMG, img)
-                cv2.imwrite(CONT_IMG, mask)
-                self.img.source = COLO_IMG
+        self.img_src = img_src
+        self.restore_session(session)
 
-    def plot_points(self) -> None:
-        """ Method to generate the plot image and display it """
-        fig = Figure(figsize=(MAX_IMG_W/100, MAX_IMG_H/100), dpi=100)
-        canvas = FigureCanvas(fig)
-        ax = fig.gca()
-
-        x_true, y_true = [np.array(self.pts_final_r)[:, 0], np.array(self.pts_final_r)[:, 1]]
-        x_eval, y_eval = [np.array(self.pts_eval_r)[:, 0], np.array(self.pts_eval_r)[:, 1]]
-        ax.plot(x_true, y_true, 'or', label="Extracted")
-        ax.plot(x_eval, y_eval, '-b', label="Evaluated")
-        ax.legend()
-        ax.grid()
-
-        if self.current_layout.x_lin.isChecked():
-            ax.set_xscale('linear')
-        else:
-            ax.set_xscale('log')
-        if self.current_layout.y_lin.isChecked():
-            ax.set_yscale('linear')
-        else:
-            ax.set_yscale('log')
+    def restore_session(self, session: Session) -> None:
+        """ Method to replay the manual steps of a session, up to the state it was saved in """
+        self.start()
+        if session.calibration is None:
+            return
 
-        canvas.draw()  # draw the canvas, cache the renderer
+        if not self.set_calibration(session.calibration):
+            return
 
-        img = np.frombuffer(canvas.tostring_rgb(), dtype='uint8').reshape(MAX_IMG_H, MAX_IMG_W, 3)
-        cv2.imwrite(PLOT_IMG, img)
-        self.img.source = PLOT_IMG
+        self.app_state = AppState.FILTER_CHOICE
+        if session.spec is not None:
+            self.restore_filter(session.spec, session.plot_area, session.roi)
+        if session.state == AppState.FILTER_CHOICE or session.spec is None:
+            self.update_image()
+            return
 
-    def copy_text(self) -> None:
-        """ Method to copy certain data """
-        text = get_copy_text(self.current_layout.combo.currentIndex(), self.var, self.coef, self.pts_final_r)
+        self.next()  # Apply the filter
+        self.img.source = self.pipeline.display(ImageStage.COLORED if session.spec.mode == FilterMode.COLORS
+                                                else ImageStage.CONTOURED)
+        if session.selection is not None:
+            self.selection.restore(session.selection)
+            height, width = session.selection.shape
+            self.img.set_mask(display_image(self.selection.selected, fit_size(width, height), keep_max=True))
+        if session.state == AppState.EDGE_SELECTION:
+            return
 
-        if text is not None:
-            QApplication.clipboard().setText(text)
+        self.app_state = AppState.EQUATION_IMAGE
+        self.restore_evaluation(session.calibration, session.evaluation or {})
+
+    def set_calibration(self, calibration: dict) -> bool:
+        """ Method to place the points of a calibration and enter their coordinates, as if done by hand """
+        layout = self.current_layout
+        boxes = (layout.x1_coord, layout.x2_coord, layout.y1_coord, layout.y2_coord)
+        for i, (box, pt, value) in enumerate(zip(boxes, calibration["axis_pixels"], calibration["axis_values"])):
+            layout.pts[i] = tuple(pt)
+            box.line.setText(f"{value}")
+        layout.x1_done, layout.x2_done, layout.y1_done, layout.y2_done = True, True, True, True
+        self.curvefinder.update_lin_log(calibration.get("x_scale", "lin") == "lin",
+                                        calibration.get("y_scale", "lin") == "lin", False)
+
+        self.img.source = self.pipeline.display(ImageStage.ORIGINAL)  # Clear the points placed by hand
+        self.img.draw_points([self.pipeline.transform.to_display(*pt) for pt in layout.pts])
+        self.app_state = AppState.COORD_ALL_SELECTED
+        return self.verify_coord()
+
+    def apply_template(self) -> None:
+        """ Method to calibrate the image with the selected template """
+        layout = self.current_layout
+        template = CalibrationTemplate.load(layout.template.currentText())
+        self.set_calibration(template.apply(self.pipeline[ImageStage.ORIGINAL], layout.refine.isChecked()))
+
+    def save_template(self) -> None:
+        """ Method to save the calibration as a template for the figures with the same axes """
+        name, ok = QInputDialog.getText(self, "Save template", "Template name :")
+        if not ok or name == "":
+            return
 
-    def evaluate(self) -> None:
-        value = np.poly1d(self.coef)(float(self.current_layout.input.text()))
-        self.current_layout.output.setText(f"{value:0.3f}")
+        try:
+            template = CalibrationTemplate.from_curvefinder(name, self.curvefinder, self.pipeline[ImageStage.ORIGINAL])
+        except ValueError as e:
+            msgBox = QMessageBox()
+            msgBox.setIcon(QMessageBox.Warning)
+            msgBox.setText(str(e))
+            msgBox.setWindowTitle("Warning")
+            msgBox.setStandardButtons(QMessageBox.Ok)
+            msgBox.exec()
+            return
+        template.save()
+
+    def restore_filter(self, spec: FilterSpec, plot_area: bool, roi: Optional[list] = None) -> None:
+        """ Method to set the filter options, without computing their previews """
+        layout = self.current_layout
+        widgets = (layout.tabs, layout.contours.combo, layout.colors.slider, layout.plot_area, layout.roi)
+        for widget in widgets:
+            widget.blockSignals(True)
+
+        layout.tabs.setCurrentIndex(spec.mode)
+        layout.contours.combo.setCurrentIndex(spec.contour)
+        layout.contours.combo_change(layout.contours.combo.currentText())  # Set the ranges of the sliders
+        layout.contours.slider1.setValue(spec.tr1)
+        layout.contours.slider2.setValue(spec.tr2)
+        layout.colors.color = QColor(*spec.color)
+        layout.colors.change_color(False)
+        layout.colors.slider.setValue(spec.thresh)
+        layout.plot_area.setChecked(plot_area)
+        layout.roi.setText(format_roi(roi))
+        layout.plot_area.setEnabled(roi is None)
+
+        for widget in widgets:
+            widget.blockSignals(False)
+
+    def restore_evaluation(self, calibration: dict, evaluation: dict) -> None:
+        """ Method to set the evaluation options and the lin/log axes, then fit the curve once """
+        layout = self.current_layout
+        widgets = (layout.x_lin, layout.x_log, layout.y_lin, layout.y_log, layout.model, layout.spinbox,
+                   layout.auto_order, layout.aggregation, layout.bin_width, layout.epsilon, layout.y_from_x,
+                   layout.x_from_y)
+        for widget in widgets:
+            widget.blockSignals(True)
+
+        (layout.x_lin if calibration.get("x_scale", "lin") == "lin" else layout.x_log).setChecked(True)
+        (layout.y_lin if calibration.get("y_scale", "lin") == "lin" else layout.y_log).setChecked(True)
+        layout.model.setCurrentIndex(ModelType[evaluation.get("model", "polynomial").upper()])
+        layout.spinbox.setValue(int(evaluation.get("order", 5)))
+        layout.auto_order.setChecked(bool(evaluation.get("auto_order", False)))
+        layout.aggregation.setCurrentIndex(Aggregation[evaluation.get("aggregation", "all").upper()])
+        layout.bin_width.setValue(float(evaluation.get("bin_width", 0)))
+        layout.epsilon.setValue(float(evaluation.get("epsilon", 0)))
+        (layout.y_from_x if evaluation.get("y_from_x", True) else layout.x_from_y).setChecked(True)
+        layout.input.setPlaceholderText("x" if layout.y_from_x.isChecked() else "y")
+        layout.output.setPlaceholderText("y" if layout.y_from_x.isChecked() else "x")
+
+        for widget in widgets:
+            widget.blockSignals(False)
+        self.update_lin_log()
 
     @property
     def app_state(self) -> AppState:
@@ -454,6 +712,9 @@ class QCurveFinder(QWidget):
         """ Method where the sequence of the app is handled """
         self.update_layout(state)
         self._app_state = state
+        self.but_save_session.setEnabled(state >= AppState.FILTER_CHOICE)
+        self.but_save_template.setEnabled(state >= AppState.FILTER_CHOICE)
+        self.but_save_image.setEnabled(state >= AppState.FILTER_CHOICE)
 
         if state == AppState.INITIAL:
             """Starting state"""
@@ -480,13 +741,14 @@ class QCurveFinder(QWidget):
             self.but_next.setEnabled(True)
 
             self.current_layout.initValues()
+            self.preview_worker.cancel()
 
-            self.pts_final_p = []
-            self.pts_final_r = []
-            self.pts_eval_r = []
+            self.pts_final = PointSet(np.empty((0, 2)), np.empty((0, 2)))
+            self.pts_eval = PointSet(np.empty((0, 2)))
+            self.remapped, self.fit_engines = {}, {}
             self.isEquationReady = False
 
-            self.img.source = ORIG_IMG
+            self.img.source = self.pipeline.display(ImageStage.ORIGINAL)
             self.img.clickEnabled = True
             self.img.coordEnabled = True
             self.img.zoomEnabled = True
@@ -508,6 +770,9 @@ class QCurveFinder(QWidget):
             self.curvefinder.update()
 
             self.resize_and_rotate()
+            rotated = self.pipeline[ImageStage.ROTATED]
+            self.tiles = TiledProcessor() if rotated.shape[0]*rotated.shape[1] > TILED_MIN_PIXELS else None
+            self.filter_cache = FilterCache(rotated, gray=self.pipeline[ImageStage.GRAY])
             self.update_image()
 
         elif state == AppState.EDGE_SELECTION:
@@ -517,31 +782,39 @@ class QCurveFinder(QWidget):
             self.img.clickEnabled = True
             self.img.maskEnabled = True
 
-            img = cv2.cvtColor(cv2.imread(CONT_IMG), cv2.COLOR_BGR2GRAY)
-            img = np.greater(img, np.zeros(img.shape))*255  # Create the contour mask
-            self.mask = np.ones(img.shape)
-            cv2.imwrite(CTMK_IMG, img)
+            img = self.pipeline[ImageStage.CONTOURED]
+            if img.ndim == 3:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            img = np.greater(img, 0).astype(np.uint8)*255  # Create the contour mask
+            self.pipeline[ImageStage.CONTOUR_MASK] = img
+            self.selection = SelectionMask(img, None if self.roi is None else roi_bounds(img.shape, self.roi))
+            self.filter_cache.clear()  # No more previews, free the memory
 
             self.current_layout.spinbox.setValue(25)
 
         elif state == AppState.EQUATION_IMAGE:
             """Selected the edges to keep"""
+            layout = self.current_layout
+            for (lin, log, is_lin) in ((layout.x_lin, layout.x_log, self.curvefinder.x_is_lin),
+                                       (layout.y_lin, layout.y_log, self.curvefinder.y_is_lin)):
+                lin.blockSignals(True)
+                log.blockSignals(True)
+                (lin if is_lin else log).setChecked(True)  # The scales may come from a template or a session
+                lin.blockSignals(False)
+                log.blockSignals(False)
             self.img.clickEnabled = False
             self.img.maskEnabled = False
-            img = cv2.cvtColor(cv2.imread(CTMK_IMG), cv2.COLOR_BGR2GRAY)
-            img = np.equal(img, self.mask)
-            pts_y, pts_x = np.where(img)
-
-            img = cv2.imread(ROTA_IMG)
-            for (x, y) in zip(pts_x, pts_y):
-                a, b = self.curvefinder.pixel_to_graph((x, y))
-                self.pts_final_p.append((x, y))
-                self.pts_final_r.append(np.array([a, b]))
-                cv2.circle(img, (x, y), 2, (0, 0, 255), -1)
-
-            cv2.imwrite(SELE_IMG, img)
-            self.img.source = SELE_IMG
-            self.img.draw_points(self.curvefinder.get_points())
+            self.pts_final = PointSet.from_pixels(self.curvefinder, self.selection.pixels())
+            self.remapped = {(self.curvefinder.x_is_lin, self.curvefinder.y_is_lin): self.pts_final}
+            self.fit_engines = {}
+
+            transform = self.pipeline.transform
+            radius = max(2, round(2/transform.scale))  # Keep the points visible once the image is scaled down
+            img = draw_selection(self.pipeline[ImageStage.ROTATED], self.selection.selected, radius=radius)
+
+            self.pipeline[ImageStage.SELECTED] = img
+            self.img.source = self.pipeline.display(ImageStage.SELECTED)
+            self.img.draw_points([transform.to_display(*pt) for pt in self.curvefinder.get_points()])
             self.instruct.setEnabled(True)
             self.set_equation()
             self.but_next.setText("Plot")
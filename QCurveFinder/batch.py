@@ -0,0 +1,312 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.connection import Connection, wait
+from typing import Dict, List, Optional, TextIO, Tuple, Union
+from .engine import FilterSpec, Extraction, calibrate, extract
+from .export import export_arrays, export_curve
+from .constants import Aggregation, ModelType, OrderCriterion, ExportOptions, TILED_MIN_PIXELS, EXPORT_EXTENSIONS
+from .pipeline import read_image
+from .templates import CalibrationTemplate
+from .tiles import TiledProcessor
+import numpy as np
+import multiprocessing
+import argparse
+import glob
+import json
+import time
+import sys
+import cv2
+import os
+
+try:
+    import yaml
+except ModuleNotFoundError:
+    yaml = None
+
+
+class BatchJob:
+    """ A single figure of a batch manifest """
+
+    def __init__(self, image: str, axis_pixels: Optional[List[List[float]]], axis_values: List[float], spec: FilterSpec,
+                 mask: Optional[str] = None, roi: Optional[Union[str, list]] = None, x_is_lin: bool = True,
+                 y_is_lin: bool = True, order: Union[int, str] = 5, y_from_x: bool = True,
+                 tile_size: Optional[int] = None, aggregation: Aggregation = Aggregation.ALL, bin_width: float = 0,
+                 epsilon: float = 0, criterion: OrderCriterion = OrderCriterion.CROSS_VALIDATION,
+                 model: ModelType = ModelType.POLYNOMIAL, template: Optional[CalibrationTemplate] = None,
+                 refine: bool = True, name: Optional[str] = None) -> None:
+        self.image = image
+        self.axis_pixels = axis_pixels
+        self.axis_values = axis_values
+        self.spec = spec
+        self.mask = mask
+        self.roi = roi
+        self.x_is_lin = x_is_lin
+        self.y_is_lin = y_is_lin
+        self.order = order
+        self.y_from_x = y_from_x
+        self.tile_size = tile_size
+        self.aggregation = aggregation
+        self.bin_width = bin_width
+        self.epsilon = epsilon
+        self.criterion = criterion
+        self.model = model
+        self.template = template  # Places the axis pixels on the image if they are not given
+        self.refine = refine
+        self.name = name or os.path.splitext(os.path.basename(image))[0]  # Of the exported file
+
+    @classmethod
+    def from_dict(cls, entry: dict, root: str = "") -> "BatchJob":
+        """
+        Create a job from a manifest entry, the paths being relative to `root`.
+
+        With a `template` (a name or the path of its .json file), the calibration of the template is used for the keys
+        missing from the entry.
+        """
+        template = entry.get("template")
+        if template is None:
+            axis_pixels = entry["axis_pixels"]
+        else:
+            if template.endswith(".json"):
+                template = os.path.join(root, template)
+            template = CalibrationTemplate.load(template)
+            entry = {"axis_values": template.axis_values, "x_scale": template.x_scale, "y_scale": template.y_scale,
+                     **entry}
+            axis_pixels = entry.get("axis_pixels")
+        mask = entry.get("mask")
+        tile_size = entry.get("tile_size")
+        roi = entry.get("roi", "plot")  # The plot area by default, "full" for the whole image
+        order = entry.get("order", 5)
+        return cls(os.path.join(root, entry["image"]), axis_pixels, entry["axis_values"],
+                   FilterSpec.from_dict(entry.get("filter", {})), None if mask is None else os.path.join(root, mask),
+                   None if roi == "full" else roi, entry.get("x_scale", "lin") == "lin",
+                   entry.get("y_scale", "lin") == "lin", order if order == "auto" else int(order),
+                   bool(entry.get("y_from_x", True)), None if tile_size is None else int(tile_size),
+                   Aggregation[entry.get("aggregation", "all").upper()], float(entry.get("bin_width", 0)),
+                   float(entry.get("epsilon", 0)), OrderCriterion[entry.get("criterion", "cross_validation").upper()],
+                   ModelType[entry.get("model", "polynomial").upper()], template, bool(entry.get("refine", True)),
+                   entry.get("name"))
+
+    def tiles(self, img: np.ndarray, tile_memory: Optional[int] = None) -> Optional[TiledProcessor]:
+        """ Tiled processor of the job, if its tile size is set, a memory budget is given or the image is large """
+        if self.tile_size is not None:
+            return TiledProcessor(self.tile_size)
+        elif tile_memory is not None:
+            return TiledProcessor.from_budget(tile_memory)
+        elif img.shape[0]*img.shape[1] > TILED_MIN_PIXELS:
+            return TiledProcessor()
+        return None
+
+    def export_path(self, option: ExportOptions, export_dir: Optional[str] = None) -> str:
+        """ Path of the binary file of the job, named after its `name`, next to the image or in `export_dir` """
+        return os.path.join(export_dir or os.path.dirname(self.image), self.name + EXPORT_EXTENSIONS[option])
+
+    def export(self, result: Extraction, option: ExportOptions, export_dir: Optional[str] = None) -> str:
+        """ Write the result in a binary format and return its path """
+        dst = self.export_path(option, export_dir)
+        curvefinder = calibrate(self.axis_pixels, self.axis_values, self.x_is_lin, self.y_is_lin)
+        metadata = {"image": self.image, **curvefinder.to_dict(), "var": result.var, **result.model.to_dict()}
+        if result.scores is not None:
+            metadata["order_scores"] = result.scores.tolist()
+        export_curve(dst, option, export_arrays(result.points, result.model), metadata)
+        return dst
+
+    def run(self, tile_memory: Optional[int] = None, export: Optional[ExportOptions] = None,
+            export_dir: Optional[str] = None) -> dict:
+        """
+        Extract the curve and return the record written to the output.
+
+        `tile_memory` is the peak memory budget in bytes of the tiled processing. With an `export` format, the result
+        is also written to a binary file whose path is in the record.
+        """
+        record = {"image": self.image}
+        try:
+            img = read_image(self.image)
+            if self.axis_pixels is None:
+                self.axis_pixels = self.template.apply(img, self.refine)["axis_pixels"]
+                record["axis_pixels"] = self.axis_pixels
+            selection = None if self.mask is None else read_image(self.mask)[:, :, 0]
+            result = extract(img, self.axis_pixels, self.axis_values, self.spec, selection, self.roi,
+                             self.x_is_lin, self.y_is_lin, self.order, self.y_from_x, self.tiles(img, tile_memory),
+                             self.aggregation, self.bin_width, self.epsilon, self.criterion, self.model)
+            if export is not None:
+                record["export"] = self.export(result, export, export_dir)
+        except Exception as e:
+            record.update(status="error", error=f"{type(e).__name__}: {e}")
+        else:
+            record.update(status="ok", **result.to_dict())
+
+        return record
+
+
+def _init_worker() -> None:
+    """ Keep OpenCV on a single thread per worker, the parallelism comes from the processes """
+    cv2.setNumThreads(1)
+
+
+def _run_job(job: BatchJob, tile_memory: Optional[int], export: Optional[ExportOptions],
+             export_dir: Optional[str]) -> dict:
+    return job.run(tile_memory, export, export_dir)
+
+
+def _run_job_process(conn: Connection, job: BatchJob, tile_memory: Optional[int], export: Optional[ExportOptions],
+                     export_dir: Optional[str]) -> None:
+    """ Run a job in its own process and send its record back """
+    _init_worker()
+    conn.send(_run_job(job, tile_memory, export, export_dir))
+    conn.close()
+
+
+def load_manifest(path: str) -> List[BatchJob]:
+    """
+    Load a JSON or YAML manifest.
+
+    The manifest holds a `figures` list and optional `defaults` applied to every figure. A figure with an `images`
+    glob pattern instead of an `image` stands for every image matching it.
+    """
+    with open(path, "r", encoding="utf-8") as stream:
+        if os.path.splitext(path)[1].lower() in (".yml", ".yaml"):
+            if yaml is None:
+                raise RuntimeError("PyYAML is required to read YAML manifests")
+            manifest = yaml.safe_load(stream)
+        else:
+            manifest = json.load(stream)
+
+    root = os.path.dirname(os.path.abspath(path))
+    defaults = manifest.get("defaults", {})
+    jobs = []
+    for entry in manifest["figures"]:
+        entry = {**defaults, **entry}
+        if "images" in entry:
+            pattern = entry.pop("images")
+            jobs.extend(BatchJob.from_dict({**entry, "image": src}, root)
+                        for src in sorted(glob.glob(os.path.join(root, pattern))))
+        else:
+            jobs.append(BatchJob.from_dict(entry, root))
+    return jobs
+
+
+def write_record(record: dict, output: TextIO) -> None:
+    """ Write a record as a JSON line """
+    output.write(json.dumps(record, default=lambda o: o.tolist() if isinstance(o, np.ndarray) else str(o)))
+    output.write("\n")
+    output.flush()
+
+
+def run_jobs(jobs: List[BatchJob], output: TextIO, workers: Optional[int] = None,
+             timeout: Optional[float] = None, tile_memory: Optional[int] = None,
+             export: Optional[ExportOptions] = None, export_dir: Optional[str] = None) -> int:
+    """
+    Run every job and return the number of failures.
+
+    The jobs are spread over `workers` processes (all the cores by default) and the records are written in their
+    completion order. With a single worker, the jobs run in this process, in order. With a `timeout`, every job runs
+    in its own process, which is killed once the timeout is over.
+    """
+    workers = workers or os.cpu_count() or 1
+    failures = 0
+
+    if timeout is not None:
+        return run_jobs_timeout(jobs, output, workers, timeout, tile_memory, export, export_dir)
+
+    if workers == 1:
+        for job in jobs:
+            record = job.run(tile_memory, export, export_dir)
+            failures += record["status"] != "ok"
+            write_record(record, output)
+        return failures
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)) or 1, initializer=_init_worker) as executor:
+        futures = {executor.submit(_run_job, job, tile_memory, export, export_dir): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as e:  # The worker died (e.g. out of memory)
+                record = {"image": futures[future].image, "status": "error", "error": f"{type(e).__name__}: {e}"}
+            failures += record["status"] != "ok"
+            write_record(record, output)
+
+    return failures
+
+
+def run_jobs_timeout(jobs: List[BatchJob], output: TextIO, workers: int, timeout: float,
+                     tile_memory: Optional[int] = None, export: Optional[ExportOptions] = None,
+                     export_dir: Optional[str] = None) -> int:
+    """
+    Run every job in its own process, at most `workers` at once, and return the number of failures.
+
+    The timeout is enforced from this process, so a job stuck in a long OpenCV call is killed as well.
+    """
+    pending = list(reversed(jobs))
+    running: Dict[Connection, Tuple[multiprocessing.Process, BatchJob, float]] = {}
+    failures = 0
+
+    while pending or running:
+        while pending and len(running) < workers:
+            job = pending.pop()
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_job_process,
+                                              args=(sender, job, tile_memory, export, export_dir), daemon=True)
+            process.start()
+            sender.close()  # Only the worker writes to it, so reading fails once the worker is gone
+            running[receiver] = (process, job, time.monotonic() + timeout)
+
+        wait_time = max(0.0, min(deadline for _, _, deadline in running.values()) - time.monotonic())
+        ready = set(wait(list(running), wait_time))
+        now = time.monotonic()
+        for conn, (process, job, deadline) in list(running.items()):
+            if conn in ready:
+                try:
+                    record = conn.recv()
+                except EOFError:  # The worker died (e.g. out of memory)
+                    process.join()
+                    record = {"image": job.image, "status": "error",
+                              "error": f"Worker exited with code {process.exitcode}"}
+            elif now >= deadline:
+                process.kill()
+                record = {"image": job.image, "status": "timeout", "error": f"Took more than {timeout} s"}
+            else:
+                continue
+
+            process.join()
+            conn.close()
+            del running[conn]
+            failures += record["status"] != "ok"
+            write_record(record, output)
+
+    return failures
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="curvefinder batch",
+                                     description="Extract the curves of every figure of a manifest without a display.")
+    parser.add_argument('manifest', help="JSON or YAML manifest describing the figures.")
+    parser.add_argument('-o', '--output', default=None, help="JSON lines output file. [Default : stdout]")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="Number of worker processes. "
+                                                                         "[Default : number of cores]")
+    parser.add_argument('-t', '--timeout', type=float, default=None, help="Timeout of a single figure in seconds, "
+                        "each figure then runs in its own process. [Default : None]")
+    parser.add_argument('-m', '--tile-memory', type=float, default=None, help="Peak memory of the tiled processing "
+                                                                              "per worker in MB. [Default : None]")
+    parser.add_argument('-e', '--export', choices=[option.name.lower() for option in ExportOptions], default=None,
+                        help="Also write every result to a binary file in this format. [Default : None]")
+    parser.add_argument('-d', '--export-dir', default=None, help="Folder of the binary files. "
+                                                                 "[Default : the folder of each image]")
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+    tile_memory = None if args.tile_memory is None else int(args.tile_memory*1024*1024)
+    export = None if args.export is None else ExportOptions[args.export.upper()]
+    if export is not None:
+        paths = [os.path.normcase(os.path.abspath(job.export_path(export, args.export_dir))) for job in jobs]
+        duplicates = sorted({path for path in paths if paths.count(path) > 1})
+        if duplicates:
+            parser.error(f"several figures would be exported to {', '.join(duplicates)}, give them a `name`")
+    if args.export_dir is not None:
+        os.makedirs(args.export_dir, exist_ok=True)
+    if args.output is None:
+        failures = run_jobs(jobs, sys.stdout, args.workers, args.timeout, tile_memory, export, args.export_dir)
+    else:
+        with open(args.output, "w", encoding="utf-8") as output:
+            failures = run_jobs(jobs, output, args.workers, args.timeout, tile_memory, export, args.export_dir)
+
+    print(f"{len(jobs) - failures}/{len(jobs)} figures extracted", file=sys.stderr)
+    return 1 if failures else 0
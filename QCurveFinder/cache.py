@@ -0,0 +1,158 @@
+from typing import Callable, Dict, Hashable, Optional
+from collections import OrderedDict
+from .constants import *
+import numpy as np
+import threading
+import hashlib
+import shutil
+import cv2
+import os
+
+
+def result_size(result: Dict[ImageStage, np.ndarray]) -> int:
+    """ Memory used by the images of a result """
+    return sum(img.nbytes for img in result.values())
+
+
+class FilterCache:
+    """
+    LRU cache of the filter results of a single image.
+
+    The grayscale version of the image is computed once and every result is kept until the memory budget is
+    exceeded, the least recently used results being dropped first.
+    """
+
+    def __init__(self, image: np.ndarray, budget: int = FILTER_CACHE_BUDGET, gray: Optional[np.ndarray] = None) -> None:
+        self.image = image
+        self.budget = budget
+        self.size = 0
+        self._gray: np.ndarray = gray
+        self._results: "OrderedDict[Hashable, Dict[ImageStage, np.ndarray]]" = OrderedDict()
+
+    @property
+    def gray(self) -> np.ndarray:
+        """ The grayscale base image """
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._results
+
+    def __getitem__(self, key: Hashable) -> Dict[ImageStage, np.ndarray]:
+        self._results.move_to_end(key)
+        return self._results[key]
+
+    def get(self, key: Hashable, compute: Callable[[], Dict[ImageStage, np.ndarray]]) -> Dict[ImageStage, np.ndarray]:
+        """ Return the result of `key`, computing and storing it if it is not cached """
+        if key in self._results:
+            return self[key]
+
+        result = compute()
+        self.put(key, result)
+        return result
+
+    def put(self, key: Hashable, result: Dict[ImageStage, np.ndarray]) -> None:
+        """ Store the result of `key` """
+        if key in self._results:
+            self.size -= result_size(self._results.pop(key))
+        self._results[key] = result
+        self.size += result_size(result)
+
+        # Evict the least recently used results, but always keep the newest one
+        while self.size > self.budget and len(self._results) > 1:
+            old_key, old_result = self._results.popitem(last=False)
+            self.size -= result_size(old_result)
+
+    def clear(self) -> None:
+        self._results.clear()
+        self.size = 0
+
+
+class DiskCache:
+    """
+    Content-addressed cache of stage results on disk, shared by every run of the app.
+
+    The key of a result holds the hash of the source image and the parameters of the stage, so it is found again
+    whatever the path of the image. Each result is a folder named after the SHA-256 of its key with a raw .npy file
+    per stage, which is memory-mapped when loaded. The folder is written under a temporary name and renamed, so a
+    result is never read half written. Once the cache is larger than its budget, the least recently used results are
+    deleted, the last use of a result being the modification time of its folder. The size of the cache is scanned on
+    the first save and then only counted, so the folder is scanned again only when the count exceeds the budget.
+    """
+
+    def __init__(self, root: str = CACHE_PATH, budget: int = DISK_CACHE_BUDGET) -> None:
+        self.root = root
+        self.budget = budget
+        self.size: Optional[int] = None  # Bytes in the cache, unknown until the first save
+
+    def __contains__(self, key: Hashable) -> bool:
+        return os.path.isdir(self.path(key))
+
+    def path(self, key: Hashable) -> str:
+        """ The folder of the result of `key` """
+        return os.path.join(self.root, hashlib.sha256(repr(key).encode("utf-8")).hexdigest())
+
+    def load(self, key: Hashable) -> Optional[Dict[ImageStage, np.ndarray]]:
+        """ Return the result of `key` as read-only memory maps, or None if it is not cached """
+        path = self.path(key)
+        try:
+            result = {ImageStage[os.path.splitext(name)[0].upper()]: np.load(os.path.join(path, name), mmap_mode="r")
+                      for name in os.listdir(path)}
+            os.utime(path)  # Most recently used
+        except (OSError, ValueError, KeyError):  # Not cached, or being evicted
+            return None
+        return result
+
+    def save(self, key: Hashable, result: Dict[ImageStage, np.ndarray]) -> None:
+        """ Store the result of `key`, doing nothing if the cache folder can not be written """
+        path = self.path(key)
+        temp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(temp)
+            for stage, img in result.items():
+                np.save(os.path.join(temp, f"{stage.name.lower()}.npy"), img)
+            os.rename(temp, path)
+        except OSError:  # Not writable, or already saved by another thread or run
+            shutil.rmtree(temp, ignore_errors=True)
+            return
+
+        if self.size is not None:
+            self.size += result_size(result)
+        if self.size is None or self.size > self.budget:
+            self.evict()
+
+    def get(self, key: Hashable, compute: Callable[[], Dict[ImageStage, np.ndarray]]) -> Dict[ImageStage, np.ndarray]:
+        """ Return the result of `key`, computing and storing it if it is not cached """
+        result = self.load(key)
+        if result is None:
+            result = compute()
+            self.save(key, result)
+        return result
+
+    def evict(self) -> None:
+        """ Delete the least recently used results until the cache fits in its budget """
+        entries, total = [], 0
+        try:
+            scan = list(os.scandir(self.root))
+        except OSError:
+            return
+        for entry in scan:
+            if entry.name.endswith(".tmp") or not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:  # Evicted by another thread or run
+                continue
+            total += size
+
+        for last_use, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        self.size = total
@@ -30,6 +30,49 @@ class CopyOptions(IntEnum):
     POLY1D = 13
 
 
+class ExportOptions(IntEnum):
+    NPY = 0
+    NPZ = 1
+    PARQUET = 2
+    HDF5 = 3
+
+
+class ImageStage(IntEnum):
+    ORIGINAL = 0
+    ROTATED = 1
+    CONTOURED = 2
+    COLORED = 3
+    CONTOUR_MASK = 4
+    SELECTED = 5
+    PLOTTED = 6
+    GRAY = 7
+
+
+class FilterMode(IntEnum):
+    CONTOURS = 0
+    COLORS = 1
+
+
+class Aggregation(IntEnum):
+    ALL = 0
+    MEDIAN = 1
+    CENTROID = 2
+
+
+class ModelType(IntEnum):
+    POLYNOMIAL = 0
+    SPLINE = 1
+    PIECEWISE_LINEAR = 2
+    HUBER = 3
+    RANSAC = 4
+
+
+class OrderCriterion(IntEnum):
+    CROSS_VALIDATION = 0
+    AIC = 1
+    BIC = 2
+
+
 class ContourOptions(IntEnum):
     CANNY = 0
     GLOBAL = 1
@@ -49,19 +92,39 @@ APP_HEIGHT = 750
 MAX_IMG_W = 1200
 MAX_IMG_H = 730
 
+FILTER_CACHE_BUDGET = 256*1024*1024  # Bytes of filter results kept in memory
+FILTER_PREVIEW_DELAY = 50  # Debounce delay of the filter previews in ms
+DISK_CACHE_BUDGET = 1024*1024*1024  # Bytes of stage results kept on disk between the runs
+
+TEMPLATE_MATCH_SIZE = 1024  # Longest side of the images whose features are matched to place a template
+TEMPLATE_FEATURES = 2000  # ORB features detected per image
+TEMPLATE_MIN_INLIERS = 12  # Matched features that must agree on the transform of a template
+
+TILE_SIZE = 2048  # Side of the tiles of the tiled processing in pixels
+TILE_OVERLAP = 16  # Pixels added on each side of a tile, wider than every filter kernel
+TILE_BYTES_PER_PIXEL = 24  # Peak memory of the tiled processing per pixel of a padded tile
+TILED_MIN_PIXELS = 64*1024*1024  # Larger images are filtered in tiles by default
+ROI_PADDING = 16  # Pixels filtered around the ROI so that its edges are filtered as in the whole image
+POLYNOMIAL_MODELS = (ModelType.POLYNOMIAL, ModelType.HUBER, ModelType.RANSAC)
+FIT_MAX_ORDER = 15  # Highest order of the polynomial fits
+FIT_CV_FOLDS = 5  # Folds of the cross-validation of the automatic fit order
+FIT_IC_TOLERANCE = 2  # AIC or BIC differences too small to choose a higher fit order
+FIT_LUT_SIZE = 64  # Bins of the piecewise-linear lookup tables
+FIT_SPLINE_KNOTS = 12  # Interior knots of the splines
+FIT_ROBUST_ITERATIONS = 50  # Iterations of the Huber regression
+FIT_RANSAC_TRIALS = 200  # Random subsets tried by RANSAC
+FIT_RANSAC_SIGMAS = 3  # Inlier threshold of RANSAC, in robust standard deviations of the residuals
+STREAMED_COPY_OPTIONS = (CopyOptions.POINTS_MATLAB, CopyOptions.POINTS_PYTHON, CopyOptions.POINTS_NUMPY,
+                         CopyOptions.POINTS_CSV, CopyOptions.COEFFS_MATLAB, CopyOptions.COEFFS_PYTHON,
+                         CopyOptions.COEFFS_NUMPY, CopyOptions.POLY1D)
+EXPORT_CHUNK = 4096  # Values formatted at once by the text exports
+
 # PATHS
 RESOURCES_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../resources/"))
 ICON_PATH = os.path.join(RESOURCES_PATH, "icon.ico")
 PH_IMAGE_PATH = os.path.join(RESOURCES_PATH, "placeholder.png")
-TEMP_PATH = os.path.join(RESOURCES_PATH, "temp/")
-ORIG_IMG = os.path.join(TEMP_PATH, "original_img.png")
-COOR_IMG = os.path.join(TEMP_PATH, "coordinate_img.png")  # TODO: Not used anymore
-ROTA_IMG = os.path.join(TEMP_PATH, "rotated_img.png")
-CONT_IMG = os.path.join(TEMP_PATH, "contoured_img.png")
-COLO_IMG = os.path.join(TEMP_PATH, "colored_img.png")
-CTMK_IMG = os.path.join(TEMP_PATH, "masked_contoured_img.png")
-SELE_IMG = os.path.join(TEMP_PATH, "selected_img.png")
-PLOT_IMG = os.path.join(TEMP_PATH, "plotted_img.png")
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".curvefinder", "cache")
+TEMPLATES_PATH = os.path.join(os.path.expanduser("~"), ".curvefinder", "templates")
 
 # TEXTS
 INITIAL_TEXT = "Select an image by pressing the `Select an image` button at the bottom and press `Start`."
@@ -85,6 +148,19 @@ COPY_OPTIONS_TEXT = ("Equation - Matlab", "Equation - Python", "Equation - Markd
                      "Equation - Excel lambda (point)", "Equation - Excel lambda (comma)",
                      "Points - Matlab", "Points - Python", "Points - NumPy", "Points - CSV",
                      "Coeff. - Matlab", "Coeff. - Python", "Coeff. - NumPy", "Poly1D - NumPy")
+COPY_OPTIONS_FILTER = ("Matlab (*.m)", "Python (*.py)", "Markdown (*.md)", "LaTeX (*.tex)", "Text (*.txt)",
+                       "Text (*.txt)", "Matlab (*.m)", "Python (*.py)", "Python (*.py)", "CSV (*.csv)",
+                       "Matlab (*.m)", "Python (*.py)", "Python (*.py)", "Python (*.py)")
+
+EXPORT_OPTIONS_TEXT = ("Binary - NumPy (.npy)", "Binary - NumPy (.npz)", "Binary - Parquet", "Binary - HDF5")
+EXPORT_OPTIONS_FILTER = ("NumPy (*.npy)", "NumPy (*.npz)", "Parquet (*.parquet)", "HDF5 (*.h5)")
+EXPORT_EXTENSIONS = (".npy", ".npz", ".parquet", ".h5")
+SESSION_FILTER = "CurveFinder session (*.cfs)"
+IMAGE_FILTER = "Images (*.png *.bmp *.jpg)"
+
+MODEL_TEXT = ("Polynomial", "Cubic spline", "Piecewise linear", "Polynomial (Huber)", "Polynomial (RANSAC)")
+
+AGGREGATION_TEXT = ("All the points", "Median per column", "Centroid per column")
 
 CONTOUR_OPTIONS_TEXT = ("Canny", "Global Thresholding", "Adaptive Mean Thresholding", "Adaptive Gaussian Thresholding",
                         "Otsu's Thresholding", "Otsu's Thresholding + Gaussian Blur")
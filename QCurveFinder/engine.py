@@ -0,0 +1,340 @@
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from .tools import CurveFinder, PointSet
+from .pipeline import read_image
+from .fitting import FitEngine
+from .models import FitModel
+from .constants import *
+import numpy as np
+import cv2
+
+
+# Colors of the contours, never black so that every contour stays in the contour mask
+CONTOUR_COLORS = np.random.RandomState(123456).randint(1, 256, (256, 3)).astype(np.uint8)
+
+
+class FilterSpec:
+    """ Description of the filter used to isolate the curve from the rest of the image """
+
+    def __init__(self, mode: FilterMode = FilterMode.CONTOURS, contour: ContourOptions = ContourOptions.CANNY,
+                 tr1: int = 0, tr2: int = 0, color: Tuple[int, int, int] = (0, 0, 0), thresh: int = 0) -> None:
+        self.mode = FilterMode(mode)
+        self.contour = ContourOptions(contour)
+        self.tr1 = int(tr1)
+        self.tr2 = int(tr2)
+        self.color = tuple(int(c) for c in color)  # RGB
+        self.thresh = int(thresh)
+
+    @classmethod
+    def from_dict(cls, spec: dict) -> "FilterSpec":
+        """ Create a filter from its manifest description """
+        mode = FilterMode[spec.get("mode", "contours").upper()]
+        color = spec.get("color", (0, 0, 0))
+        if isinstance(color, str):
+            color = tuple(int(color.lstrip("#")[i:i + 2], 16) for i in (0, 2, 4))
+        return cls(mode, ContourOptions[spec.get("contour", "canny").upper()], spec.get("tr1", 0), spec.get("tr2", 0),
+                   color, spec.get("thresh", 0))
+
+    def key(self) -> tuple:
+        """ Hashable key of the parameters that change the result of the filter """
+        if self.mode == FilterMode.COLORS:
+            return self.mode, self.color, self.thresh
+        return self.mode, self.contour, self.tr1, self.tr2
+
+    def to_dict(self) -> dict:
+        """ Return the manifest description of the filter """
+        return {"mode": self.mode.name.lower(), "contour": self.contour.name.lower(), "tr1": self.tr1,
+                "tr2": self.tr2, "color": list(self.color), "thresh": self.thresh}
+
+
+class Extraction:
+    """ Result of the extraction of a curve """
+
+    def __init__(self, points: PointSet, model: FitModel, var: str, scores: Optional[np.ndarray] = None) -> None:
+        self.points = points
+        self.model = model
+        self.var = var
+        self.scores = scores  # Score of every order when the order is chosen automatically
+
+    @property
+    def coefs(self) -> np.ndarray:
+        return self.model.coefs
+
+    def to_dict(self) -> dict:
+        record = {"var": self.var, **self.model.to_dict(), "points": self.points.graph.tolist()}
+        if self.scores is not None:
+            record["order_scores"] = self.scores.tolist()
+        return record
+
+
+def rotate_image(img: np.ndarray, curvefinder: CurveFinder) -> np.ndarray:
+    """ Rotate the image so that the axes are aligned with the pixels """
+    rot_matrix = curvefinder.get_rotation_matrix()
+    return cv2.warpAffine(img, rot_matrix, img.shape[1::-1], flags=cv2.INTER_LINEAR)
+
+
+def contour_filter(gray: np.ndarray, mode: ContourOptions, tr1: int, tr2: int) -> np.ndarray:
+    """ Apply a contour filter to a grayscale image and return the binary image """
+    if mode == ContourOptions.CANNY:
+        img = cv2.Canny(gray, tr1, tr2)
+
+    elif mode == ContourOptions.GLOBAL:
+        img = cv2.medianBlur(gray, 5)
+        ret, img = cv2.threshold(img, tr1, tr2, cv2.THRESH_BINARY)
+
+    elif mode == ContourOptions.ADAPTIVE_MEAN:
+        img = cv2.medianBlur(gray, 5)
+        img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 11, 2)
+
+    elif mode == ContourOptions.ADAPTIVE_GAUSSIAN:
+        img = cv2.medianBlur(gray, 5)
+        img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+
+    elif mode == ContourOptions.OTSUS:
+        ret, img = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+
+    elif mode == ContourOptions.OTSUS_GAUSSIAN_BLUR:
+        img = cv2.GaussianBlur(gray, (5, 5), 0)
+        ret, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+
+    else:
+        img = gray
+
+    return img
+
+
+def find_contours(binary: np.ndarray) -> Sequence[np.ndarray]:
+    """ Find every contour of a binary image """
+    cont, h = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+    return cont
+
+
+def contour_points(contours: Sequence[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """ Return the (x, y) pixels of every contour with the index of the contour of each pixel """
+    if len(contours) == 0:
+        return np.empty((0, 2), dtype=np.intc), np.empty(0, dtype=np.intp)
+
+    lengths = np.fromiter((len(c) for c in contours), dtype=np.intp, count=len(contours))
+    pts = np.concatenate(contours).reshape(-1, 2)
+    labels = np.repeat(np.arange(len(contours)), lengths)
+    return pts, labels
+
+
+def color_contours(shape: Tuple[int, ...], contours: Sequence[np.ndarray]) -> np.ndarray:
+    """ Draw the contours on a black BGR image, each 8-connected group of contour pixels having its own color """
+    mask = np.zeros(shape[:2], dtype=np.uint8)
+    pts, labels = contour_points(contours)
+    mask[pts[:, 1], pts[:, 0]] = 1
+    count, labels = cv2.connectedComponents(mask, connectivity=8)
+    img = CONTOUR_COLORS[labels % len(CONTOUR_COLORS)]
+    img[labels == 0] = 0
+    return img
+
+
+def color_mask(img: np.ndarray, color: Tuple[int, int, int], thresh: int) -> np.ndarray:
+    """ Mask of the pixels of a BGR image within `thresh` of an RGB color """
+    red, green, blue = color
+    lower = np.array([blue - thresh, green - thresh, red - thresh]).clip(0, 255)
+    upper = np.array([blue + thresh, green + thresh, red + thresh]).clip(0, 255)
+    return cv2.inRange(img, lower, upper)
+
+
+def filter_preview(img: np.ndarray, gray: np.ndarray, spec: FilterSpec, tiles=None,
+                   roi: Optional[Sequence] = None) -> Dict[ImageStage, np.ndarray]:
+    """
+    Images of the filter stage: the contoured image and, for the colors mode, the colored preview.
+
+    With a ROI, only its crop is filtered and the rest of the contoured image is left black.
+    """
+    if roi is not None:
+        x0, y0, x1, y1 = roi_bounds(img.shape, roi, ROI_PADDING)
+        inside = roi_mask((y1 - y0, x1 - x0), roi, (x0, y0)) > 0
+        result = {}
+        for stage, crop in filter_preview(img[y0:y1, x0:x1], gray[y0:y1, x0:x1], spec, tiles).items():
+            full = img.copy() if stage == ImageStage.COLORED else np.zeros(img.shape[:2] + crop.shape[2:], np.uint8)
+            full[y0:y1, x0:x1][inside] = crop[inside]
+            result[stage] = full
+        return result
+
+    if spec.mode == FilterMode.COLORS:
+        mask = color_mask(img, spec.color, spec.thresh)
+        colored = cv2.addWeighted(cv2.bitwise_and(img, img, mask=mask), 0.5, img, 0.5, 0)
+        return {ImageStage.CONTOURED: mask, ImageStage.COLORED: colored}
+
+    if tiles is not None:
+        return {ImageStage.CONTOURED: tiles.color_contours(img, spec)}
+
+    binary = contour_filter(gray, spec.contour, spec.tr1, spec.tr2)
+    return {ImageStage.CONTOURED: color_contours(binary.shape, find_contours(binary))}
+
+
+def contour_mask(img: np.ndarray, spec: FilterSpec) -> np.ndarray:
+    """ Mask (0 or 255) of the candidate curve pixels of a rotated BGR image """
+    if spec.mode == FilterMode.COLORS:
+        return color_mask(img, spec.color, spec.thresh)
+
+    binary = contour_filter(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), spec.contour, spec.tr1, spec.tr2)
+    mask = np.zeros(binary.shape, dtype=np.uint8)
+    pts, labels = contour_points(find_contours(binary))
+    mask[pts[:, 1], pts[:, 0]] = 255
+    return mask
+
+
+def plot_area(curvefinder: CurveFinder) -> List[int]:
+    """ The (x, y, width, height) rectangle of the rotated image bounded by the four calibration points """
+    pts = np.array(curvefinder.get_points())
+    x0, y0 = np.floor(pts.min(axis=0)).astype(int)
+    x1, y1 = np.ceil(pts.max(axis=0)).astype(int) + 1
+    return [int(x0), int(y0), int(x1 - x0), int(y1 - y0)]
+
+
+def parse_roi(text: str) -> Optional[list]:
+    """
+    ROI entered as "x, y, width, height" for a rectangle or "x1, y1; x2, y2; ..." for a polygon, None if empty.
+
+    A ValueError is raised when the text is neither.
+    """
+    if not text.strip():
+        return None
+    error = ValueError(f"`{text}` is neither a rectangle `x, y, width, height` nor a polygon `x1, y1; x2, y2; ...`")
+    try:
+        pts = [[float(v) for v in pt.split(",")] for pt in text.strip().strip(";").split(";")]
+    except ValueError:
+        raise error from None
+
+    if len(pts) == 1 and len(pts[0]) == 4:
+        x, y, w, h = (int(round(v)) for v in pts[0])
+        if w > 0 and h > 0:
+            return [x, y, w, h]
+    elif len(pts) >= 3 and all(len(pt) == 2 for pt in pts):
+        return pts
+    raise error
+
+
+def format_roi(roi: Optional[Sequence]) -> str:
+    """ Text of a ROI as read by `parse_roi` """
+    if roi is None:
+        return ""
+    if np.ndim(roi) == 2:
+        return "; ".join(f"{x:.10g}, {y:.10g}" for x, y in roi)
+    return ", ".join(f"{v}" for v in roi)
+
+
+def roi_bounds(shape: Tuple[int, ...], roi: Sequence, padding: int = 0) -> Tuple[int, int, int, int]:
+    """ The (x0, y0, x1, y1) bounds of a rectangle or polygon ROI, padded and clipped to the image """
+    if np.ndim(roi) == 2:  # [[x, y], ...] polygon
+        pts = np.asarray(roi, dtype=float)
+        x0, y0 = np.floor(pts.min(axis=0)).astype(int)
+        x1, y1 = np.ceil(pts.max(axis=0)).astype(int) + 1
+    else:
+        x0, y0, w, h = (int(v) for v in roi)
+        x1, y1 = x0 + w, y0 + h
+
+    return (min(max(x0 - padding, 0), shape[1]), min(max(y0 - padding, 0), shape[0]),
+            min(max(x1 + padding, 0), shape[1]), min(max(y1 + padding, 0), shape[0]))
+
+
+def roi_mask(shape: Tuple[int, ...], roi: Sequence, origin: Tuple[int, int] = (0, 0)) -> np.ndarray:
+    """
+    Selection mask of a (x, y, width, height) rectangle or a [[x, y], ...] polygon.
+
+    `origin` is the position of the top left pixel of the mask, for the mask of a crop.
+    """
+    mask = np.zeros(shape[:2], dtype=np.uint8)
+    if np.ndim(roi) == 2:
+        pts = np.round(np.asarray(roi, dtype=float) - origin).astype(np.int32)
+        cv2.fillPoly(mask, [pts], 255)
+    else:
+        x, y, w, h = (int(v) for v in roi)
+        x, y = x - origin[0], y - origin[1]
+        mask[max(y, 0):max(y + h, 0), max(x, 0):max(x + w, 0)] = 255
+    return mask
+
+
+def select_mask(mask: np.ndarray, selection: Optional[np.ndarray] = None) -> np.ndarray:
+    """ Mask (0 or 1) of the curve pixels kept by the selection """
+    selected = mask > 0
+    if selection is not None:
+        selected &= selection > 0
+    return selected.view(np.uint8)
+
+
+def mask_pixels(selected: np.ndarray) -> np.ndarray:
+    """ Return the (x, y) coordinates of the nonzero pixels of a mask """
+    pts_y, pts_x = np.nonzero(selected)
+    return np.column_stack((pts_x, pts_y))
+
+
+def extract_pixels(mask: np.ndarray, selection: Optional[np.ndarray] = None) -> np.ndarray:
+    """ Return the (x, y) coordinates of the curve pixels kept by the selection """
+    return mask_pixels(select_mask(mask, selection))
+
+
+def draw_selection(img: np.ndarray, selected: np.ndarray, color: Tuple[int, int, int] = (0, 0, 255),
+                   radius: int = 2) -> np.ndarray:
+    """ Draw a disk on every selected pixel of a copy of the BGR image, with a single dilation of the mask """
+    kernel = np.zeros((2*radius + 1, 2*radius + 1), dtype=np.uint8)
+    cv2.circle(kernel, (radius, radius), radius, 1, -1)  # Same disk as cv2.circle on the image
+
+    img = img.copy()
+    img[cv2.dilate(selected, kernel) > 0] = color
+    return img
+
+
+def calibrate(axis_pixels: Sequence[Tuple[float, float]], axis_values: Sequence[float], x_is_lin: bool = True,
+              y_is_lin: bool = True) -> CurveFinder:
+    """ Create a CurveFinder from the pixels and values of X1, X2, Y1 and Y2 """
+    curvefinder = CurveFinder()
+    curvefinder.set_coord_points(np.asarray(axis_values, dtype=float))
+    curvefinder.set_axis_points([tuple(pt) for pt in axis_pixels])
+    curvefinder.update_lin_log(x_is_lin, y_is_lin)
+    return curvefinder
+
+
+def extract(image: Union[str, np.ndarray], axis_pixels: Sequence[Tuple[float, float]], axis_values: Sequence[float],
+            spec: FilterSpec, selection: Optional[np.ndarray] = None, roi: Optional[Union[str, Sequence]] = None,
+            x_is_lin: bool = True, y_is_lin: bool = True, order: Union[int, str] = 5, y_from_x: bool = True,
+            tiles=None, aggregation: Aggregation = Aggregation.ALL, bin_width: float = 0, epsilon: float = 0,
+            criterion: OrderCriterion = OrderCriterion.CROSS_VALIDATION,
+            model: ModelType = ModelType.POLYNOMIAL) -> Extraction:
+    """
+    Extract a curve from an image without any user interface.
+
+    The selection mask and the ROI are given in the space of the rotated image, the ROI being a (x, y, width, height)
+    rectangle, a [[x, y], ...] polygon or "plot" for the area bounded by the calibration points. Only the crop of the
+    ROI is rotated, filtered and extracted. With a `TiledProcessor` as `tiles`, this is done tile by tile and the whole
+    rotated crop is never held in memory. The points are reduced as in `PointSet.reduce` before the fit, whose order
+    is chosen with `criterion` when it is "auto" and a polynomial model is fitted.
+    """
+    img = read_image(image) if isinstance(image, str) else image
+    curvefinder = calibrate(axis_pixels, axis_values, x_is_lin, y_is_lin)
+    if isinstance(roi, str):
+        roi = plot_area(curvefinder)
+
+    height, width = img.shape[:2]
+    x0, y0, x1, y1 = (0, 0, width, height) if roi is None else roi_bounds(img.shape, roi, ROI_PADDING)
+    matrix = curvefinder.get_rotation_matrix()
+    matrix[:, 2] -= (x0, y0)  # Rotate only the crop
+    if tiles is None:
+        mask = contour_mask(cv2.warpAffine(img, matrix, (x1 - x0, y1 - y0), flags=cv2.INTER_LINEAR), spec)
+    else:
+        mask = tiles.contour_mask(img, spec, matrix, (x1 - x0, y1 - y0))
+    del img
+
+    if selection is not None:
+        selection = selection[y0:y1, x0:x1]
+    if roi is not None:
+        roi = roi_mask(mask.shape, roi, (x0, y0))
+        selection = roi if selection is None else cv2.bitwise_and(selection, roi)
+
+    pixels = extract_pixels(mask, selection) if tiles is None else tiles.pixels(mask, selection)
+    pixels = pixels + (x0, y0)
+    if len(pixels) == 0:
+        raise ValueError("No curve pixel was found with this filter and selection")
+
+    points = PointSet.from_pixels(curvefinder, pixels).reduce(aggregation, bin_width, epsilon, y_from_x,
+                                                              not x_is_lin, not y_is_lin)
+    engine, scores = FitEngine(points), None
+    if order == "auto":
+        order, scores = engine.select_order(criterion, y_from_x, not x_is_lin, not y_is_lin)
+    fitted = engine.model(model, order, y_from_x, not x_is_lin, not y_is_lin)
+    return Extraction(points, fitted, "x" if y_from_x else "y", scores)
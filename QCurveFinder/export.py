@@ -0,0 +1,94 @@
+from typing import Callable, Dict, Optional
+from .tools import PointSet
+from .models import FitModel
+from .constants import *
+import numpy as np
+import json
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Not installed, or built for another version of NumPy
+    pyarrow = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def export_arrays(points: PointSet, model: FitModel, evaluated: Optional[PointSet] = None) -> Dict[str, np.ndarray]:
+    """ The extracted points (with their pixels if known), the evaluated curve and the coefficients of the model """
+    arrays = {"points": points.graph}
+    if points.pixels is not None:
+        arrays["pixels"] = points.pixels
+    arrays["evaluated"] = (model.eval_points() if evaluated is None else evaluated).graph
+    arrays["coefs"] = np.asarray(model.coefs, dtype=float)
+    return arrays
+
+
+def to_json(metadata: dict, arrays: Optional[Dict[str, np.ndarray]] = None) -> str:
+    """ The metadata, with the arrays if given, as a JSON string """
+    return json.dumps({**metadata, **{name: arr.tolist() for name, arr in (arrays or {}).items()}})
+
+
+def write_npy(dst: str, arrays: Dict[str, np.ndarray], metadata: dict) -> None:
+    """
+    Write the points to a .npy file and the rest to a .json file with the same name.
+
+    The points are copied into a memory map of the file, without any intermediate buffer, so the .npy file can be
+    memory-mapped as well when read with `np.load(dst, mmap_mode="r")`.
+    """
+    points = arrays["points"]
+    out = np.lib.format.open_memmap(dst, mode="w+", dtype=points.dtype, shape=points.shape)
+    if out.size:
+        out[:] = points
+        out.flush()
+    del out  # Close the memory map
+
+    with open(os.path.splitext(dst)[0] + ".json", "w", encoding="utf-8") as stream:
+        stream.write(to_json(metadata, {name: arr for name, arr in arrays.items() if name != "points"}))
+
+
+def write_npz(dst: str, arrays: Dict[str, np.ndarray], metadata: dict) -> None:
+    """ Write every array to an uncompressed .npz file, the metadata being a JSON string array """
+    np.savez(dst, **arrays, metadata=np.array(to_json(metadata)))
+
+
+def write_parquet(dst: str, arrays: Dict[str, np.ndarray], metadata: dict) -> None:
+    """ Write the points as x and y columns (and px and py for the pixels), the rest being in the schema metadata """
+    if pyarrow is None:
+        raise RuntimeError("pyarrow is required to export to Parquet")
+
+    columns = {"x": arrays["points"][:, 0], "y": arrays["points"][:, 1]}
+    if "pixels" in arrays:
+        columns.update(px=arrays["pixels"][:, 0], py=arrays["pixels"][:, 1])
+    table = pyarrow.table(columns)
+    others = {name: arr for name, arr in arrays.items() if name not in ("points", "pixels")}
+    table = table.replace_schema_metadata({"curvefinder": to_json(metadata, others)})
+    pyarrow.parquet.write_table(table, dst)
+
+
+def write_hdf5(dst: str, arrays: Dict[str, np.ndarray], metadata: dict) -> None:
+    """ Write every array as a dataset, the metadata being a JSON string attribute of the file """
+    if h5py is None:
+        raise RuntimeError("h5py is required to export to HDF5")
+
+    with h5py.File(dst, "w") as file:
+        for name, arr in arrays.items():
+            file.create_dataset(name, data=arr)
+        file.attrs["metadata"] = to_json(metadata)
+
+
+WRITERS: Dict[ExportOptions, Callable[[str, Dict[str, np.ndarray], dict], None]] = {
+    ExportOptions.NPY: write_npy,
+    ExportOptions.NPZ: write_npz,
+    ExportOptions.PARQUET: write_parquet,
+    ExportOptions.HDF5: write_hdf5,
+}
+
+
+def export_curve(dst: str, option: ExportOptions, arrays: Dict[str, np.ndarray], metadata: dict) -> None:
+    """ Write the arrays of a curve and its metadata (calibration, model, ...) in a binary format """
+    WRITERS[ExportOptions(option)](dst, arrays, metadata)
@@ -0,0 +1,242 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from .tools import PointSet
+from .models import FitModel, PolynomialModel, SplineModel, LookupTableModel
+from .constants import *
+import numpy as np
+import os
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def executor() -> ThreadPoolExecutor:
+    """ Thread pool shared by the cross-validations, NumPy releases the GIL in the factorizations """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=min(FIT_CV_FOLDS, os.cpu_count() or 1))
+    return _executor
+
+
+def scaled_vander(a: np.ndarray, max_order: int, scale: Optional[np.ndarray] = None) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """ Vandermonde matrix by increasing power with its columns scaled to a unit norm (or by `scale`) """
+    vander = np.vander(a, max_order + 1, increasing=True)
+    if scale is None:
+        scale = np.sqrt((vander*vander).sum(axis=0))  # Same column scaling as np.polyfit
+        scale[scale == 0] = 1
+    return vander/scale, scale
+
+
+def solve_order(r: np.ndarray, qtb: np.ndarray, order: int, rcond: float) -> np.ndarray:
+    """ Scaled coefficients (lowest power first) of an order, from the QR factorization of a higher order """
+    rows, cols = min(len(qtb), order + 1), order + 1
+    return np.linalg.lstsq(r[:rows, :cols], qtb[:rows], rcond=rcond)[0]  # Handles rank deficient fits
+
+
+def huber_coefficients(a: np.ndarray, b: np.ndarray, order: int, iterations: int = FIT_ROBUST_ITERATIONS) \
+        -> np.ndarray:
+    """ Polynomial fit with the Huber loss, by iteratively reweighted least squares """
+    vander, scale = scaled_vander(a, order)
+    weights = np.ones(len(a))
+    for _ in range(iterations):
+        root = np.sqrt(weights)
+        coefs = np.linalg.lstsq(vander*root[:, np.newaxis], b*root, rcond=None)[0]
+        residuals = np.abs(vander @ coefs - b)
+        delta = 1.345*1.4826*np.median(residuals)  # 95 % efficient on gaussian noise
+        if delta == 0:
+            break
+
+        new_weights = np.minimum(1, delta/np.maximum(residuals, np.finfo(float).tiny))
+        if np.allclose(new_weights, weights, atol=1e-6):
+            break
+        weights = new_weights
+
+    return (coefs/scale)[::-1]
+
+
+def ransac_coefficients(a: np.ndarray, b: np.ndarray, order: int, trials: int = FIT_RANSAC_TRIALS) -> np.ndarray:
+    """
+    Polynomial fit on the largest set of inliers found by RANSAC.
+
+    The inliers are the points closer to a fit of order + 1 random points than a few robust standard deviations of
+    the residuals of the Huber fit, and the result is the least squares fit of the inliers of the best trial.
+    """
+    vander, scale = scaled_vander(a, order)
+    if len(a) <= order + 1:
+        return (np.linalg.lstsq(vander, b, rcond=None)[0]/scale)[::-1]
+
+    residuals = np.polyval(huber_coefficients(a, b, order), a) - b
+    sigma = 1.4826*np.median(np.abs(residuals - np.median(residuals)))  # Standard deviation of gaussian noise
+    threshold = max(FIT_RANSAC_SIGMAS*sigma, np.sqrt(np.finfo(float).eps)*np.abs(b).max())  # Exact points
+    samples = np.random.RandomState(123456).randint(0, len(a), (trials, order + 1))  # Same result on every run
+    best, best_count = np.ones(len(a), dtype=bool), -1
+    for sample in samples:
+        coefs = np.linalg.lstsq(vander[sample], b[sample], rcond=None)[0]
+        inliers = np.abs(vander @ coefs - b) <= threshold
+        count = int(inliers.sum())
+        if count > best_count:
+            best, best_count = inliers, count
+
+    return (np.linalg.lstsq(vander[best], b[best], rcond=None)[0]/scale)[::-1]
+
+
+class FitEngine:
+    """
+    Polynomial fits of a set of points, for every order, orientation and lin/log axis.
+
+    The Vandermonde matrix of the highest order is factorized once per orientation and lin/log axis. Its columns are
+    ordered by increasing power, so the QR factorization of a lower order is the leading block of this one and every
+    order is solved from it with a small triangular system. The fits are memoized.
+    """
+
+    def __init__(self, points: PointSet, max_order: int = FIT_MAX_ORDER) -> None:
+        self.points = points
+        self.max_order = max_order
+        self._factors: Dict[tuple, tuple] = {}
+        self._fits: Dict[tuple, Tuple[np.ndarray, PointSet]] = {}
+        self._orders: Dict[tuple, Tuple[int, np.ndarray]] = {}
+        self._models: Dict[tuple, FitModel] = {}
+
+    def variables(self, y_from_x: bool = True, x_is_log: bool = False, y_is_log: bool = False) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """ The independent and the dependent variables of the fit, in log10 on a log axis """
+        x = self.points.column(0, x_is_log)
+        y = self.points.column(1, y_is_log)
+        return (x, y) if y_from_x else (y, x)
+
+    def factorize(self, y_from_x: bool = True, x_is_log: bool = False, y_is_log: bool = False) -> tuple:
+        """ The R factor, Q^T b and the column scales of the Vandermonde matrix of the highest order """
+        key = (y_from_x, x_is_log, y_is_log)
+        if key not in self._factors:
+            a, b = self.variables(y_from_x, x_is_log, y_is_log)
+            vander, scale = scaled_vander(a, self.max_order)
+            q, r = np.linalg.qr(vander)
+            self._factors[key] = (r, q.T @ b, scale)
+        return self._factors[key]
+
+    def coefficients(self, order: int, y_from_x: bool = True, x_is_log: bool = False,
+                     y_is_log: bool = False) -> np.ndarray:
+        """ Coefficients of the fit, highest power first as with np.polyfit """
+        r, qtb, scale = self.factorize(y_from_x, x_is_log, y_is_log)
+        coefs = solve_order(r, qtb, order, len(self.points)*np.finfo(float).eps)
+        return (coefs/scale[:order + 1])[::-1]
+
+    def fit(self, order: int, y_from_x: bool = True, x_is_log: bool = False,
+            y_is_log: bool = False) -> Tuple[np.ndarray, PointSet]:
+        """ Fit a polynomial on the points and return its coefficients with 100 evaluated points """
+        if order > self.max_order:
+            raise ValueError(f"The order of the fit is higher than {self.max_order}")
+
+        key = (order, y_from_x, x_is_log, y_is_log)
+        if key not in self._fits:
+            coefs = self.coefficients(order, y_from_x, x_is_log, y_is_log)
+            a, b = self.variables(y_from_x, x_is_log, y_is_log)
+            a_log, b_log = (x_is_log, y_is_log) if y_from_x else (y_is_log, x_is_log)
+
+            eval_a = np.linspace(a.min(), a.max(), 100)
+            eval_b = np.polyval(coefs, eval_a)
+            if a_log:
+                eval_a = np.power(10, eval_a)
+            if b_log:
+                eval_b = np.power(10, eval_b)
+
+            eval_pts = np.column_stack((eval_a, eval_b) if y_from_x else (eval_b, eval_a))
+            self._fits[key] = (coefs, PointSet(eval_pts))
+        return self._fits[key]
+
+    def fold_errors(self, a: np.ndarray, b: np.ndarray, test: np.ndarray) -> np.ndarray:
+        """ Sum of the squared errors of every order on the test points, fitted on the others """
+        train_a, scale = scaled_vander(a[~test], self.max_order)
+        q, r = np.linalg.qr(train_a)
+        qtb = q.T @ b[~test]
+        test_a = scaled_vander(a[test], self.max_order, scale)[0]
+
+        rcond = len(train_a)*np.finfo(float).eps
+        errors = np.empty(self.max_order + 1)
+        for order in range(self.max_order + 1):
+            residuals = test_a[:, :order + 1] @ solve_order(r, qtb, order, rcond) - b[test]
+            errors[order] = residuals @ residuals
+        return errors
+
+    def cross_validate(self, folds: int = FIT_CV_FOLDS, y_from_x: bool = True, x_is_log: bool = False,
+                       y_is_log: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Root mean squared error of the k-fold cross-validation of every order, with its standard error.
+
+        Each fold is factorized once for the highest order and runs on the shared thread pool, the folds only reading
+        the arrays of the points. The standard error comes from the spread of the mean squared errors of the folds.
+        """
+        a, b = self.variables(y_from_x, x_is_log, y_is_log)
+        fold = np.random.RandomState(123456).permutation(len(a)) % folds  # Same folds on every run
+        errors = np.array(list(executor().map(lambda k: self.fold_errors(a, b, fold == k), range(folds))))
+        rmse = np.sqrt(errors.sum(axis=0)/len(a))
+
+        fold_mse = errors/np.bincount(fold, minlength=folds)[:, None]
+        mse_error = fold_mse.std(axis=0, ddof=1)/np.sqrt(folds)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return rmse, np.nan_to_num(mse_error/(2*rmse))  # Standard error of the RMSE from the one of the MSE
+
+    def information_criterion(self, criterion: OrderCriterion, y_from_x: bool = True, x_is_log: bool = False,
+                              y_is_log: bool = False) -> np.ndarray:
+        """ AIC or BIC of every order, from the residuals of the fits on every point """
+        a, b = self.variables(y_from_x, x_is_log, y_is_log)
+        vander = np.vander(a, self.max_order + 1)
+        n = len(a)
+        scores = np.empty(self.max_order + 1)
+        for order in range(self.max_order + 1):
+            coefs = self.coefficients(order, y_from_x, x_is_log, y_is_log)
+            residuals = vander[:, self.max_order - order:] @ coefs - b
+            rss = max(residuals @ residuals, np.finfo(float).tiny)
+            penalty = 2 if criterion == OrderCriterion.AIC else np.log(n)
+            scores[order] = n*np.log(rss/n) + penalty*(order + 1)
+        return scores
+
+    def select_order(self, criterion: OrderCriterion = OrderCriterion.CROSS_VALIDATION, y_from_x: bool = True,
+                     x_is_log: bool = False, y_is_log: bool = False) -> Tuple[int, np.ndarray]:
+        """
+        Choose the order of the fit and return it with the score of every order, the lowest score being the best.
+
+        The score is the cross-validated RMSE or an information criterion. The best scores of the high orders are
+        often only better by chance, so the lowest order whose score is within one standard error of the best RMSE,
+        or within FIT_IC_TOLERANCE of the best criterion, is chosen. The orders that need more points than the fit has
+        are never chosen.
+        """
+        key = (OrderCriterion(criterion), y_from_x, x_is_log, y_is_log)
+        if key not in self._orders:
+            if len(self.points) < 2*FIT_CV_FOLDS and criterion == OrderCriterion.CROSS_VALIDATION:
+                criterion = OrderCriterion.BIC  # Too few points for the folds
+            if criterion == OrderCriterion.CROSS_VALIDATION:
+                scores, errors = self.cross_validate(FIT_CV_FOLDS, y_from_x, x_is_log, y_is_log)
+            else:
+                scores = self.information_criterion(criterion, y_from_x, x_is_log, y_is_log)
+                errors = np.full(len(scores), FIT_IC_TOLERANCE)
+
+            valid = np.arange(len(scores)) < len(self.points)
+            scores_valid = np.where(valid & np.isfinite(scores), scores, np.inf)
+            best = int(np.argmin(scores_valid))
+            order = int(np.argmax(scores_valid <= scores_valid[best] + errors[best]))
+            self._orders[key] = (order, scores)
+        return self._orders[key]
+
+    def model(self, model_type: ModelType = ModelType.POLYNOMIAL, order: int = 5, y_from_x: bool = True,
+              x_is_log: bool = False, y_is_log: bool = False) -> FitModel:
+        """ Fit a model on the points, the order only being used by the polynomials """
+        model_type = ModelType(model_type)
+        key = (model_type, order if model_type in POLYNOMIAL_MODELS else None, y_from_x, x_is_log, y_is_log)
+        if key not in self._models:
+            a, b = self.variables(y_from_x, x_is_log, y_is_log)
+            if model_type == ModelType.SPLINE:
+                model = SplineModel.fit(a, b, 3, FIT_SPLINE_KNOTS, y_from_x, x_is_log, y_is_log)
+            elif model_type == ModelType.PIECEWISE_LINEAR:
+                model = LookupTableModel.fit(a, b, FIT_LUT_SIZE, y_from_x, x_is_log, y_is_log)
+            else:
+                if model_type == ModelType.HUBER:
+                    coefs = huber_coefficients(a, b, order)
+                elif model_type == ModelType.RANSAC:
+                    coefs = ransac_coefficients(a, b, order)
+                else:
+                    coefs = self.coefficients(order, y_from_x, x_is_log, y_is_log)
+                model = PolynomialModel(coefs, a.min(), a.max(), y_from_x, x_is_log, y_is_log, model_type)
+            self._models[key] = model
+        return self._models[key]
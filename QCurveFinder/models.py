@@ -0,0 +1,219 @@
+from typing import Iterator, Optional, Union
+from scipy.interpolate import LSQUnivariateSpline, splev
+from .tools import PointSet, get_copy_text, iter_copy_text
+from .constants import *
+from abc import ABC, abstractmethod
+import numpy as np
+
+
+def format_array(values: np.ndarray, sep: str = ", ") -> str:
+    return sep.join(f"{v}" for v in values)
+
+
+class FitModel(ABC):
+    """
+    Model fitted on the points, in the fitted space where a log axis is in log10.
+
+    Every model is evaluated by calling it and exported with `copy_text`, which takes the same arguments as
+    `get_copy_text` and returns None for the formats the model can not be written in.
+    """
+
+    name: str = ""
+
+    def __init__(self, a_min: float, a_max: float, y_from_x: bool = True, x_is_log: bool = False,
+                 y_is_log: bool = False) -> None:
+        self.a_min = a_min
+        self.a_max = a_max
+        self.y_from_x = y_from_x
+        self.a_log, self.b_log = (x_is_log, y_is_log) if y_from_x else (y_is_log, x_is_log)
+
+    @abstractmethod
+    def __call__(self, a: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        """ Evaluate the model at the independent variable `a` """
+
+    @property
+    @abstractmethod
+    def coefs(self) -> np.ndarray:
+        """ The coefficients of the model """
+
+    def eval_points(self, count: int = 100) -> PointSet:
+        """ Points of the model over the range of the fitted points, in graph coordinates """
+        eval_a = np.linspace(self.a_min, self.a_max, count)
+        eval_b = self(eval_a)
+        if self.a_log:
+            eval_a = np.power(10, eval_a)
+        if self.b_log:
+            eval_b = np.power(10, eval_b)
+        return PointSet(np.column_stack((eval_a, eval_b) if self.y_from_x else (eval_b, eval_a)))
+
+    def copy_text(self, mode: CopyOptions, var: str, pts: Union[PointSet, np.ndarray]) -> Optional[str]:
+        if mode in (CopyOptions.POINTS_MATLAB, CopyOptions.POINTS_PYTHON, CopyOptions.POINTS_NUMPY,
+                    CopyOptions.POINTS_CSV):
+            return get_copy_text(mode, var, [], pts)
+        return None
+
+    def iter_text(self, mode: CopyOptions, var: str, pts: Union[PointSet, np.ndarray]) -> Iterator[str]:
+        """ Same as `copy_text` in pieces to be written as they come, nothing being yielded if it returns None """
+        if mode in (CopyOptions.POINTS_MATLAB, CopyOptions.POINTS_PYTHON, CopyOptions.POINTS_NUMPY,
+                    CopyOptions.POINTS_CSV):
+            yield from iter_copy_text(mode, var, [], pts)
+            return
+
+        text = self.copy_text(mode, var, pts)
+        if text is not None:
+            yield text
+
+    def to_dict(self) -> dict:
+        return {"model": self.name}
+
+
+class PolynomialModel(FitModel):
+    """
+    Polynomial, the coefficients being ordered by decreasing power as with np.polyfit.
+
+    The model type tells how it was fitted: by least squares, with the Huber loss or by RANSAC.
+    """
+
+    def __init__(self, coefs: np.ndarray, a_min: float, a_max: float, y_from_x: bool = True, x_is_log: bool = False,
+                 y_is_log: bool = False, model_type: ModelType = ModelType.POLYNOMIAL) -> None:
+        super().__init__(a_min, a_max, y_from_x, x_is_log, y_is_log)
+        self._coefs = np.asarray(coefs, dtype=float)
+        self.model_type = ModelType(model_type)
+        self.name = self.model_type.name.lower()
+
+    def __call__(self, a: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        return np.polyval(self._coefs, a)
+
+    @property
+    def coefs(self) -> np.ndarray:
+        return self._coefs
+
+    def copy_text(self, mode: CopyOptions, var: str, pts: Union[PointSet, np.ndarray]) -> Optional[str]:
+        return get_copy_text(mode, var, self._coefs, pts)
+
+    def iter_text(self, mode: CopyOptions, var: str, pts: Union[PointSet, np.ndarray]) -> Iterator[str]:
+        return iter_copy_text(mode, var, self._coefs, pts)
+
+    def to_dict(self) -> dict:
+        return {"model": self.name, "order": len(self._coefs) - 1, "coefs": self._coefs.tolist()}
+
+
+class SplineModel(FitModel):
+    """ Cubic B-spline """
+
+    name = "spline"
+
+    def __init__(self, knots: np.ndarray, coefs: np.ndarray, degree: int, a_min: float, a_max: float,
+                 y_from_x: bool = True, x_is_log: bool = False, y_is_log: bool = False) -> None:
+        super().__init__(a_min, a_max, y_from_x, x_is_log, y_is_log)
+        self.knots = np.asarray(knots, dtype=float)
+        self._coefs = np.asarray(coefs, dtype=float)
+        self.degree = degree
+
+    @classmethod
+    def fit(cls, a: np.ndarray, b: np.ndarray, degree: int = 3, knots: int = FIT_SPLINE_KNOTS, y_from_x: bool = True,
+            x_is_log: bool = False, y_is_log: bool = False) -> "SplineModel":
+        """
+        Least squares spline with `knots` interior knots at the quantiles of the abscissas.
+
+        The number of knots smooths the spline and keeps it compact. The points with the same abscissa are averaged
+        and weighted by their count.
+        """
+        unique_a, inverse, counts = np.unique(a, return_inverse=True, return_counts=True)
+        mean_b = np.bincount(inverse, b)/counts
+        degree = min(degree, len(unique_a) - 1)
+        if degree < 1:
+            raise ValueError("A spline needs at least two distinct abscissas")
+
+        knots = min(knots, len(unique_a) - degree - 1)
+        while True:
+            inner = np.unique(np.quantile(unique_a, np.linspace(0, 1, knots + 2)[1:-1])) if knots > 0 else []
+            try:
+                spline = LSQUnivariateSpline(unique_a, mean_b, inner, w=np.sqrt(counts), k=degree)
+                break
+            except ValueError:  # The knots do not meet the Schoenberg-Whitney conditions
+                if knots == 0:
+                    raise
+                knots //= 2
+
+        inner = spline.get_knots()
+        knots = np.concatenate(([inner[0]]*degree, inner, [inner[-1]]*degree))  # Boundary knots of multiplicity k+1
+        return cls(knots, spline.get_coeffs(), degree, a.min(), a.max(), y_from_x, x_is_log, y_is_log)
+
+    def __call__(self, a: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        coefs = np.concatenate((self._coefs, np.zeros(self.degree + 1)))  # Padded like the coefficients of splrep
+        result = splev(a, (self.knots, coefs, self.degree))
+        return result if np.ndim(a) else float(result)
+
+    @property
+    def coefs(self) -> np.ndarray:
+        return self._coefs
+
+    def copy_text(self, mode: CopyOptions, var: str, pts: Union[PointSet, np.ndarray]) -> Optional[str]:
+        if mode == CopyOptions.EQUATION_MATLAB:
+            return f"fnval(spmak([{format_array(self.knots, ' ')}], [{format_array(self._coefs, ' ')}]), {var})"
+        elif mode == CopyOptions.EQUATION_PYTHON:
+            return f"scipy.interpolate.BSpline(np.array([{format_array(self.knots)}]), " \
+                   f"np.array([{format_array(self._coefs)}]), {self.degree})({var})"
+        elif mode == CopyOptions.EQUATION_MARKDOWN:
+            return f"Spline of degree {self.degree} with {len(self.knots)} knots"
+        elif mode == CopyOptions.COEFFS_MATLAB:
+            return f"spmak([{format_array(self.knots, ' ')}], [{format_array(self._coefs, ' ')}])"
+        elif mode == CopyOptions.COEFFS_PYTHON:
+            return f"([{format_array(self.knots)}], [{format_array(self._coefs)}], {self.degree})"
+        elif mode == CopyOptions.COEFFS_NUMPY:
+            return f"(np.array([{format_array(self.knots)}]), np.array([{format_array(self._coefs)}]), {self.degree})"
+        return super().copy_text(mode, var, pts)
+
+    def to_dict(self) -> dict:
+        return {"model": self.name, "degree": self.degree, "knots": self.knots.tolist(), "coefs": self._coefs.tolist()}
+
+
+class LookupTableModel(FitModel):
+    """ Piecewise-linear lookup table """
+
+    name = "piecewise_linear"
+
+    def __init__(self, table: np.ndarray, y_from_x: bool = True, x_is_log: bool = False,
+                 y_is_log: bool = False) -> None:
+        table = np.asarray(table, dtype=float).reshape(-1, 2)
+        super().__init__(table[0, 0], table[-1, 0], y_from_x, x_is_log, y_is_log)
+        self.table = table
+
+    @classmethod
+    def fit(cls, a: np.ndarray, b: np.ndarray, size: int = FIT_LUT_SIZE, y_from_x: bool = True,
+            x_is_log: bool = False, y_is_log: bool = False) -> "LookupTableModel":
+        """ Table of the median of the points in `size` bins of equal width """
+        width = np.ptp(a)/size
+        points = PointSet(np.column_stack((a, b)))
+        if width > 0:
+            points = points.reduce(Aggregation.MEDIAN, width*(1 + 1e-9))  # The last point stays in the last bin
+        else:
+            points = points.reduce(Aggregation.MEDIAN)
+        return cls(points.graph, y_from_x, x_is_log, y_is_log)
+
+    def __call__(self, a: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        return np.interp(a, self.table[:, 0], self.table[:, 1])
+
+    @property
+    def coefs(self) -> np.ndarray:
+        return self.table[:, 1]
+
+    def copy_text(self, mode: CopyOptions, var: str, pts: Union[PointSet, np.ndarray]) -> Optional[str]:
+        a, b = format_array(self.table[:, 0]), format_array(self.table[:, 1])
+        if mode == CopyOptions.EQUATION_MATLAB:
+            return f"interp1([{format_array(self.table[:, 0], ' ')}], [{format_array(self.table[:, 1], ' ')}], {var})"
+        elif mode == CopyOptions.EQUATION_PYTHON:
+            return f"np.interp({var}, [{a}], [{b}])"
+        elif mode == CopyOptions.EQUATION_MARKDOWN:
+            return f"Piecewise-linear table of {len(self.table)} points"
+        elif mode == CopyOptions.COEFFS_MATLAB:
+            return get_copy_text(CopyOptions.POINTS_MATLAB, var, [], self.table)
+        elif mode == CopyOptions.COEFFS_PYTHON:
+            return get_copy_text(CopyOptions.POINTS_PYTHON, var, [], self.table)
+        elif mode == CopyOptions.COEFFS_NUMPY:
+            return get_copy_text(CopyOptions.POINTS_NUMPY, var, [], self.table)
+        return super().copy_text(mode, var, pts)
+
+    def to_dict(self) -> dict:
+        return {"model": self.name, "table": self.table.tolist()}
@@ -0,0 +1,140 @@
+from typing import Dict, Tuple, Union
+from .constants import *
+import numpy as np
+import cv2
+import os
+
+
+def read_image(src: str) -> np.ndarray:
+    """ Read an image as a BGR array, even when the path contains Unicode characters """
+    with open(src, "rb") as stream:
+        img = cv2.imdecode(np.frombuffer(stream.read(), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    if img is None:
+        raise ValueError(f"Unable to decode the image `{src}`")
+
+    return img
+
+
+def write_image(dst: str, img: np.ndarray) -> None:
+    """ Write an image to disk, even when the path contains Unicode characters """
+    ok, buffer = cv2.imencode(os.path.splitext(dst)[1] or ".png", img)
+    if not ok:
+        raise ValueError(f"Unable to encode the image `{dst}`")
+
+    buffer.tofile(dst)
+
+
+def fit_size(width: int, height: int, max_w: int = MAX_IMG_W, max_h: int = MAX_IMG_H) -> Tuple[int, int]:
+    """ Size of an image scaled to fit in the box while keeping its aspect ratio (same rounding as Qt) """
+    new_w = max_h*width//height
+    if new_w <= max_w:
+        return new_w, max_h
+    return max_w, max_w*height//width
+
+
+def pyramid_down(img: np.ndarray, keep_max: bool = False) -> np.ndarray:
+    """ Halve the size of an image, keeping the maximum of each 2x2 block for sparse images like contours """
+    if not keep_max:
+        return cv2.pyrDown(img)
+
+    height, width = img.shape[0] // 2 * 2, img.shape[1] // 2 * 2
+    return cv2.dilate(img[:height, :width], np.ones((2, 2), dtype=np.uint8), anchor=(0, 0))[::2, ::2]
+
+
+def display_image(img: np.ndarray, size: Tuple[int, int], keep_max: bool = False) -> np.ndarray:
+    """
+    Scale an image to the display size.
+
+    The image is first halved through a pyramid while it is more than twice the display size, so that the final
+    resize only works on a small image.
+    """
+    width, height = size
+    while img.shape[1] >= 2*width and img.shape[0] >= 2*height:
+        img = pyramid_down(img, keep_max)
+
+    if (img.shape[1], img.shape[0]) == size:
+        return img
+    elif img.shape[1] > width:
+        interpolation = cv2.INTER_NEAREST if keep_max else cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_LINEAR
+    return cv2.resize(img, size, interpolation=interpolation)
+
+
+class DisplayTransform:
+    """ Transform between the coordinates of the working image and the ones of its display """
+
+    def __init__(self, image_size: Tuple[int, int], display_size: Tuple[int, int]) -> None:
+        self.sx: float = display_size[0]/image_size[0]
+        self.sy: float = display_size[1]/image_size[1]
+
+    @property
+    def scale(self) -> float:
+        """ Average scale from the image to the display """
+        return (self.sx + self.sy)/2
+
+    def to_display(self, x: float, y: float) -> Tuple[float, float]:
+        return x*self.sx, y*self.sy
+
+    def to_image(self, x: float, y: float) -> Tuple[float, float]:
+        return x/self.sx, y/self.sy
+
+
+class ImagePipeline:
+    """
+    Class keeping the result of every stage of the app in memory.
+
+    The stages are kept in full resolution, only their display is scaled to fit in the image box.
+    """
+
+    keep_max_stages: Tuple[ImageStage, ...] = (ImageStage.CONTOURED, ImageStage.CONTOUR_MASK)
+
+    def __init__(self) -> None:
+        self.stages: Dict[ImageStage, np.ndarray] = {}
+        self.displays: Dict[ImageStage, np.ndarray] = {}
+
+    def __getitem__(self, stage: ImageStage) -> np.ndarray:
+        return self.stages[stage]
+
+    def __setitem__(self, stage: ImageStage, img: np.ndarray) -> None:
+        self.stages[stage] = img
+        self.displays.pop(stage, None)
+
+    def __contains__(self, stage: ImageStage) -> bool:
+        return stage in self.stages
+
+    def update(self, stages: Dict[ImageStage, np.ndarray]) -> None:
+        """ Set the result of several stages """
+        for stage, img in stages.items():
+            self[stage] = img
+
+    def clear(self) -> None:
+        """ Forget the result of every stage """
+        self.stages.clear()
+        self.displays.clear()
+
+    def load(self, src: Union[str, np.ndarray]) -> np.ndarray:
+        """ Load an image in full resolution (a path or its pixels) as the original stage """
+        img = read_image(src) if isinstance(src, str) else src
+        self.clear()
+        self.stages[ImageStage.ORIGINAL] = img
+        return img
+
+    @property
+    def transform(self) -> DisplayTransform:
+        """ Transform between the original image, which has the size of every working stage, and its display """
+        height, width = self.stages[ImageStage.ORIGINAL].shape[:2]
+        return DisplayTransform((width, height), fit_size(width, height))
+
+    def display(self, stage: ImageStage) -> np.ndarray:
+        """ The image of a stage scaled to fit in the image box, computed once per result """
+        if stage not in self.displays:
+            img = self.stages[stage]
+            self.displays[stage] = display_image(img, fit_size(img.shape[1], img.shape[0]),
+                                                 stage in self.keep_max_stages)
+        return self.displays[stage]
+
+    def export(self, stage: ImageStage, dst: str) -> None:
+        """ Write the result of a stage to disk, in full resolution """
+        write_image(dst, self.stages[stage])
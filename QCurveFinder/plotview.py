@@ -0,0 +1,40 @@
+from PyQt5 import QtGui
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from matplotlib.figure import Figure
+
+from .tools import PointSet
+from .widgets import array_to_qimage
+from .constants import *
+import numpy as np
+
+
+class PlotView:
+    """
+    Plot of the extracted and the evaluated points.
+
+    The figure and its lines are created once, each update only sets the data of the lines and redraws the canvas. The
+    drawn image shares the RGBA buffer of the canvas, without any copy or encoding.
+    """
+
+    def __init__(self, width: int = MAX_IMG_W, height: int = MAX_IMG_H, dpi: int = 100) -> None:
+        self.figure: Figure = Figure(figsize=(width/dpi, height/dpi), dpi=dpi)
+        self.canvas: FigureCanvas = FigureCanvas(self.figure)
+        self.ax = self.figure.gca()
+        self.extracted, = self.ax.plot([], [], 'or', label="Extracted")
+        self.evaluated, = self.ax.plot([], [], '-b', label="Evaluated")
+        self.ax.legend()
+        self.ax.grid()
+
+    def update(self, extracted: PointSet, evaluated: PointSet, x_is_log: bool = False,
+               y_is_log: bool = False) -> QtGui.QImage:
+        """ Update the plot and return its image, which stays valid until the next update """
+        self.extracted.set_data(extracted.column(0), extracted.column(1))
+        self.evaluated.set_data(evaluated.column(0), evaluated.column(1))
+        self.ax.set_xscale('log' if x_is_log else 'linear')
+        self.ax.set_yscale('log' if y_is_log else 'linear')
+        self.ax.relim()
+        self.ax.autoscale_view()
+
+        self.canvas.draw()
+        return array_to_qimage(np.asarray(self.canvas.buffer_rgba()), rgb=True)
@@ -0,0 +1,55 @@
+from typing import List, Optional, Tuple
+from .engine import mask_pixels
+import numpy as np
+import cv2
+
+
+class SelectionMask:
+    """
+    Curve pixels selected with the brush, stored as a single uint8 mask (0 or 1).
+
+    Each stroke is drawn directly in the mask and its bounding rectangle is recorded. Only those dirty rectangles are
+    intersected with the contour mask when the selection is read. The contour pixels can be restricted to the
+    (x0, y0, x1, y1) `bounds` of a ROI, only those are then searched for the selected pixels.
+    """
+
+    def __init__(self, contour_mask: np.ndarray, bounds: Optional[Tuple[int, int, int, int]] = None) -> None:
+        self.contour: np.ndarray = contour_mask
+        self.height, self.width = contour_mask.shape[:2]
+        self.bounds: Tuple[int, int, int, int] = bounds or (0, 0, self.width, self.height)
+        self._selected: np.ndarray = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.dirty: List[Tuple[int, int, int, int]] = []  # (x0, y0, x1, y1) of the strokes not yet evaluated
+
+    def paint(self, x: int, y: int, radius: int, selected: bool = True) -> None:
+        """ Select (or unselect) the pixels in a disk """
+        cv2.circle(self._selected, (x, y), radius, 1 if selected else 0, -1)
+
+        x0, y0 = max(x - radius, 0), max(y - radius, 0)
+        x1, y1 = min(x + radius + 1, self.width), min(y + radius + 1, self.height)
+        if x0 < x1 and y0 < y1:
+            self.dirty.append((x0, y0, x1, y1))
+
+    def update(self) -> None:
+        """ Keep only the contour pixels in the rectangles painted since the last update """
+        for (x0, y0, x1, y1) in self.dirty:
+            region = self._selected[y0:y1, x0:x1]
+            np.minimum(region, self.contour[y0:y1, x0:x1], out=region)  # Mask values are 0 or 1
+        self.dirty.clear()
+
+    @property
+    def selected(self) -> np.ndarray:
+        """ The mask (0 or 1) of the selected curve pixels """
+        self.update()
+        return self._selected
+
+    def pixels(self) -> np.ndarray:
+        """ Return the (x, y) coordinates of the selected curve pixels """
+        x0, y0, x1, y1 = self.bounds
+        return mask_pixels(self.selected[y0:y1, x0:x1]) + (x0, y0)
+
+    def restore(self, selected: np.ndarray) -> None:
+        """ Replace the selection, e.g. by the one of a saved session, keeping only its contour pixels """
+        if selected.shape[:2] != (self.height, self.width):
+            raise ValueError("The selection does not have the size of the contour mask")
+        self._selected = np.minimum(selected, 1).astype(np.uint8)
+        self.dirty = [(0, 0, self.width, self.height)]
@@ -0,0 +1,99 @@
+from typing import Optional
+from .engine import FilterSpec
+from .constants import *
+import numpy as np
+import hashlib
+import json
+import os
+
+
+def file_hash(path: str, chunk: int = 1024*1024) -> str:
+    """ SHA-256 of a file, read by chunks """
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for block in iter(lambda: stream.read(chunk), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def rle_encode(mask: np.ndarray) -> dict:
+    """ Run-length encoding of a binary mask in row-major order, the first run being the one of zeros """
+    flat = mask.ravel() != 0
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return {"shape": list(mask.shape), "counts": counts.tolist()}
+
+
+def rle_decode(rle: dict) -> np.ndarray:
+    """ Binary mask (0 or 1) of a run-length encoding """
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = (np.arange(len(counts)) % 2).astype(np.uint8)
+    return np.repeat(values, counts).reshape(rle["shape"])
+
+
+class Session:
+    """
+    Manual steps of the extraction of a figure, saved to resume it later.
+
+    A session holds whichever of the calibration, the filter and its region, the painted selection and the evaluation
+    options were done, with the state to resume at and the SHA-256 of the image to check that it is reopened on the
+    same figure. The calibration uses the keys of a batch manifest and the selection is run-length encoded.
+    """
+
+    def __init__(self, image: str, image_hash: str, state: AppState = AppState.STARTED,
+                 calibration: Optional[dict] = None, spec: Optional[FilterSpec] = None, plot_area: bool = True,
+                 selection: Optional[np.ndarray] = None, evaluation: Optional[dict] = None,
+                 roi: Optional[list] = None) -> None:
+        self.image = image
+        self.image_hash = image_hash
+        self.state = AppState(state)
+        self.calibration = calibration
+        self.spec = spec
+        self.plot_area = plot_area
+        self.selection = selection
+        self.evaluation = evaluation
+        self.roi = roi  # Region entered instead of the plot area
+
+    @classmethod
+    def from_dict(cls, session: dict) -> "Session":
+        spec, selection = session.get("filter"), session.get("selection")
+        return cls(session["image"], session["image_hash"], AppState[session.get("state", "started").upper()],
+                   session.get("calibration"), None if spec is None else FilterSpec.from_dict(spec),
+                   session.get("plot_area", True), None if selection is None else rle_decode(selection),
+                   session.get("evaluation"), session.get("roi"))
+
+    def to_dict(self) -> dict:
+        session = {"version": VER, "image": self.image, "image_hash": self.image_hash, "state": self.state.name.lower()}
+        if self.calibration is not None:
+            session["calibration"] = self.calibration
+        if self.spec is not None:
+            session.update({"filter": self.spec.to_dict(), "plot_area": self.plot_area})
+            if self.roi is not None:
+                session["roi"] = self.roi
+        if self.selection is not None:
+            session["selection"] = rle_encode(self.selection)
+        if self.evaluation is not None:
+            session["evaluation"] = self.evaluation
+        return session
+
+    @classmethod
+    def load(cls, path: str) -> "Session":
+        with open(path, "r", encoding="utf-8") as stream:
+            return cls.from_dict(json.load(stream))
+
+    def save(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as stream:
+            json.dump(self.to_dict(), stream)
+
+    def find_image(self, path: str) -> Optional[str]:
+        """
+        Return the image of the session saved at `path`, if it is unchanged.
+
+        The image is searched at its saved path, then next to the session file in case both were moved together.
+        """
+        for src in (self.image, os.path.join(os.path.dirname(os.path.abspath(path)), os.path.basename(self.image))):
+            if os.path.isfile(src) and file_hash(src) == self.image_hash:
+                return src
+        return None
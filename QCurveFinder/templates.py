@@ -0,0 +1,128 @@
+from typing import List, Optional, Sequence, Tuple
+from .pipeline import read_image, write_image
+from .tools import CurveFinder
+from .constants import *
+import numpy as np
+import json
+import cv2
+import os
+
+
+def reference_image(img: np.ndarray, max_size: int = TEMPLATE_MATCH_SIZE) -> Tuple[np.ndarray, float]:
+    """ Grayscale image scaled down to fit in `max_size` for the feature matching, with its scale """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    scale = min(1.0, max_size/max(gray.shape[:2]))
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+
+def match_affine(reference: np.ndarray, gray: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Affine transform (rotation, uniform scale and translation) from the reference to the grayscale image.
+
+    The ORB features of both images are matched and the transform is estimated with RANSAC. None is returned when
+    too few features agree on it.
+    """
+    orb = cv2.ORB_create(TEMPLATE_FEATURES)
+    ref_kps, ref_des = orb.detectAndCompute(reference, None)
+    kps, des = orb.detectAndCompute(gray, None)
+    if ref_des is None or des is None:
+        return None
+
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(ref_des, des)
+    if len(matches) < TEMPLATE_MIN_INLIERS:
+        return None
+
+    src = np.float32([ref_kps[m.queryIdx].pt for m in matches])
+    dst = np.float32([kps[m.trainIdx].pt for m in matches])
+    matrix, inliers = cv2.estimateAffinePartial2D(src, dst, method=cv2.RANSAC, ransacReprojThreshold=3)
+    if matrix is None or inliers.sum() < TEMPLATE_MIN_INLIERS:
+        return None
+    return matrix
+
+
+def list_templates(root: str = TEMPLATES_PATH) -> List[str]:
+    """ Names of the saved templates """
+    if not os.path.isdir(root):
+        return []
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(root) if name.endswith(".json"))
+
+
+class CalibrationTemplate:
+    """
+    Named calibration reused on the figures with the same axes and layout.
+
+    A template holds the pixels of X1, X2, Y1 and Y2 on a reference image, their values and the lin/log scales, with
+    the same keys as a batch manifest. A scaled-down grayscale copy of the reference image is saved next to it, to
+    place the points on a new image by feature matching.
+    """
+
+    def __init__(self, name: str, axis_pixels: Sequence[Sequence[float]], axis_values: Sequence[float],
+                 x_scale: str = "lin", y_scale: str = "lin", image_size: Optional[Sequence[int]] = None,
+                 reference: Optional[np.ndarray] = None, reference_scale: float = 1.0) -> None:
+        if not name or os.path.basename(name) != name or name.startswith("."):
+            raise ValueError(f"Invalid template name `{name}`")
+
+        self.name = name
+        self.axis_pixels = [[float(v) for v in pt] for pt in axis_pixels]
+        self.axis_values = [float(v) for v in axis_values]
+        self.x_scale = x_scale
+        self.y_scale = y_scale
+        self.image_size = None if image_size is None else [int(v) for v in image_size]  # (width, height)
+        self.reference = reference
+        self.reference_scale = reference_scale
+
+    @classmethod
+    def from_curvefinder(cls, name: str, curvefinder: CurveFinder, img: np.ndarray) -> "CalibrationTemplate":
+        """ Template of the calibration of an image """
+        reference, scale = reference_image(img)
+        return cls(name, image_size=(img.shape[1], img.shape[0]), reference=reference, reference_scale=scale,
+                   **curvefinder.to_dict())
+
+    @classmethod
+    def load(cls, name: str, root: str = TEMPLATES_PATH) -> "CalibrationTemplate":
+        """ Load a template by name, or from the path of its .json file """
+        path = name if name.endswith(".json") else os.path.join(root, f"{name}.json")
+        with open(path, "r", encoding="utf-8") as stream:
+            template = json.load(stream)
+
+        reference_path = os.path.splitext(path)[0] + ".png"
+        reference = read_image(reference_path)[:, :, 0] if os.path.isfile(reference_path) else None
+        return cls(template["name"], template["axis_pixels"], template["axis_values"], template.get("x_scale", "lin"),
+                   template.get("y_scale", "lin"), template.get("image_size"), reference,
+                   template.get("reference_scale", 1.0))
+
+    def save(self, root: str = TEMPLATES_PATH) -> None:
+        os.makedirs(root, exist_ok=True)
+        with open(os.path.join(root, f"{self.name}.json"), "w", encoding="utf-8") as stream:
+            json.dump({**self.calibration(), "name": self.name, "image_size": self.image_size,
+                       "reference_scale": self.reference_scale}, stream)
+        if self.reference is not None:
+            write_image(os.path.join(root, f"{self.name}.png"), self.reference)
+
+    def calibration(self, axis_pixels: Optional[Sequence[Sequence[float]]] = None) -> dict:
+        """ The calibration with the keys of a batch manifest """
+        return {"axis_pixels": [list(pt) for pt in (axis_pixels or self.axis_pixels)],
+                "axis_values": list(self.axis_values), "x_scale": self.x_scale, "y_scale": self.y_scale}
+
+    def apply(self, img: np.ndarray, refine: bool = True) -> dict:
+        """
+        Calibration of a new image with the axes of the template.
+
+        With `refine`, the points are moved by the transform matching the features of the reference image to the ones
+        of the new image. Otherwise, or if the matching fails, they are only scaled to the size of the new image.
+        """
+        pts = np.asarray(self.axis_pixels, dtype=float)
+        matrix = None
+        if refine and self.reference is not None:
+            gray, scale = reference_image(img)
+            matrix = match_affine(self.reference, gray)
+
+        if matrix is not None:
+            pts = (pts*self.reference_scale) @ matrix[:, :2].T + matrix[:, 2]
+            pts /= scale
+        elif self.image_size is not None:
+            pts *= (img.shape[1]/self.image_size[0], img.shape[0]/self.image_size[1])
+
+        return self.calibration(pts.tolist())
@@ -0,0 +1,259 @@
+from typing import Iterator, List, Optional, Tuple
+from .engine import FilterSpec, CONTOUR_COLORS, contour_filter, find_contours, contour_points, color_mask, \
+    mask_pixels
+from .constants import *
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import numpy as np
+import cv2
+
+
+Rect = Tuple[int, int, int, int]  # (x0, y0, x1, y1)
+
+
+def otsu_threshold(hist: np.ndarray) -> int:
+    """ Otsu's threshold of a 256 bins histogram, the same as the one of cv2.THRESH_OTSU """
+    hist = hist.astype(float).ravel()
+    levels = np.arange(256)
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    sum0 = np.cumsum(hist*levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mu0 = sum0/w0
+        mu1 = (sum0[-1] - sum0)/w1
+        between = np.nan_to_num(w0*w1*(mu0 - mu1)**2)
+    return int(np.argmax(between))
+
+
+class TiledProcessor:
+    """
+    Rotate, filter and extract a large image in overlapping tiles.
+
+    Every tile is processed with `overlap` extra pixels on each side and only its core is kept, so the filters see
+    the same neighbourhood as on the whole image. Canny's hysteresis is the only step that is not local, so it is
+    done over the whole image from the weak and strong edges of the tiles. The contours that cross a tile edge are
+    split by the tiles and stitched back together when labelled.
+    """
+
+    def __init__(self, tile_size: int = TILE_SIZE, overlap: int = TILE_OVERLAP) -> None:
+        self.tile_size = tile_size
+        self.overlap = overlap
+
+    @classmethod
+    def from_budget(cls, budget: int, overlap: int = TILE_OVERLAP) -> "TiledProcessor":
+        """ Processor whose tile intermediates fit in a memory budget in bytes """
+        side = int(np.sqrt(budget/TILE_BYTES_PER_PIXEL)) - 2*overlap
+        return cls(max(side, 4*overlap), overlap)
+
+    def tiles(self, width: int, height: int) -> Iterator[Tuple[Rect, Rect]]:
+        """ Iterate over the core and the padded rectangles of the tiles """
+        for y0 in range(0, height, self.tile_size):
+            for x0 in range(0, width, self.tile_size):
+                x1, y1 = min(x0 + self.tile_size, width), min(y0 + self.tile_size, height)
+                padded = (max(x0 - self.overlap, 0), max(y0 - self.overlap, 0),
+                          min(x1 + self.overlap, width), min(y1 + self.overlap, height))
+                yield (x0, y0, x1, y1), padded
+
+    @staticmethod
+    def source_tile(img: np.ndarray, rect: Rect, matrix: Optional[np.ndarray] = None) -> np.ndarray:
+        """ A tile of the image, or of the image rotated by `matrix` """
+        x0, y0, x1, y1 = rect
+        if matrix is None:
+            return img[y0:y1, x0:x1]
+
+        tile_matrix = matrix.copy()
+        tile_matrix[:, 2] -= (x0, y0)  # Output pixel (0, 0) is the pixel (x0, y0) of the whole rotated image
+        return cv2.warpAffine(img, tile_matrix, (x1 - x0, y1 - y0), flags=cv2.INTER_LINEAR)
+
+    @staticmethod
+    def gray_tile(tile: np.ndarray) -> np.ndarray:
+        return tile if tile.ndim == 2 else cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY)
+
+    def otsu(self, img: np.ndarray, spec: FilterSpec, matrix: Optional[np.ndarray] = None,
+             size: Optional[Tuple[int, int]] = None) -> int:
+        """ Otsu's threshold of the whole image, from the histograms of the tiles """
+        width, height = size or img.shape[1::-1]
+        hist = np.zeros((256, 1), dtype=np.float32)
+        for (x0, y0, x1, y1), (px0, py0, px1, py1) in self.tiles(width, height):
+            gray = self.gray_tile(self.source_tile(img, (px0, py0, px1, py1), matrix))
+            if spec.contour == ContourOptions.OTSUS_GAUSSIAN_BLUR:
+                gray = cv2.GaussianBlur(gray, (5, 5), 0)
+            core = np.ascontiguousarray(gray[y0 - py0:y1 - py0, x0 - px0:x1 - px0])
+            hist += cv2.calcHist([core], [0], None, [256], [0, 256])
+
+        return otsu_threshold(hist)
+
+    def binary_tile(self, gray: np.ndarray, spec: FilterSpec, otsu: Optional[int]) -> np.ndarray:
+        """ Filter a grayscale tile, Otsu's threshold being the one of the whole image """
+        if spec.contour == ContourOptions.OTSUS:
+            return cv2.threshold(gray, otsu, 255, cv2.THRESH_BINARY)[1]
+        elif spec.contour == ContourOptions.OTSUS_GAUSSIAN_BLUR:
+            return cv2.threshold(cv2.GaussianBlur(gray, (5, 5), 0), otsu, 255, cv2.THRESH_BINARY)[1]
+        return contour_filter(gray, spec.contour, spec.tr1, spec.tr2)
+
+    def canny(self, img: np.ndarray, spec: FilterSpec, matrix: Optional[np.ndarray] = None,
+              size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        """
+        Canny edges (0 or 255) of the whole image, the same as cv2.Canny.
+
+        The weak and strong edges of each tile are the edges of a Canny with both thresholds at the low and the high
+        one. The hysteresis keeps the 8-connected groups of weak edges holding a strong edge: the groups are labelled
+        in each tile, merged across the tile edges from the labels along the seams, and the edges are rewritten in
+        place. Besides the edges, only the tiles and the seams are held in memory.
+        """
+        width, height = size or img.shape[1::-1]
+        low, high = sorted((spec.tr1, spec.tr2))
+        edges = np.zeros((height, width), dtype=np.uint8)  # 1 for the weak edges, 2 for the strong ones
+        for (x0, y0, x1, y1), (px0, py0, px1, py1) in self.tiles(width, height):
+            gray = self.gray_tile(self.source_tile(img, (px0, py0, px1, py1), matrix))
+            core = (slice(y0 - py0, y1 - py0), slice(x0 - px0, x1 - px0))
+            edges[y0:y1, x0:x1] = (cv2.Canny(gray, low, low)[core] > 0).view(np.uint8) + \
+                                  (cv2.Canny(gray, high, high)[core] > 0)
+
+        # Label the groups of each tile, with the labels on both sides of every seam
+        columns = {seam: np.zeros((2, height), dtype=np.int32) for seam in range(self.tile_size, width, self.tile_size)}
+        rows = {seam: np.zeros((2, width), dtype=np.int32) for seam in range(self.tile_size, height, self.tile_size)}
+        strong, offsets, count = [], [], 0
+        for x0, y0, x1, y1 in self.cores(width, height):
+            tile_count, labels = self.tile_groups(edges, (x0, y0, x1, y1), count)
+            strong.append(np.unique(labels[edges[y0:y1, x0:x1] == 2]))
+            offsets.append(count)
+            for seam, side, column in ((x0, 1, 0), (x1, 0, -1)):
+                if seam in columns:
+                    columns[seam][side, y0:y1] = labels[:, column]
+            for seam, side, row in ((y0, 1, 0), (y1, 0, -1)):
+                if seam in rows:
+                    rows[seam][side, x0:x1] = labels[row]
+            count += tile_count - 1
+
+        components = self.merge([seam for seam in (*columns.values(), *rows.values())], count)
+        linked = np.zeros(components.max() + 1, dtype=bool)
+        linked[components[np.concatenate(strong)]] = True
+        linked[0] = False
+
+        # Keep the groups linked to a strong edge, tile by tile
+        for (x0, y0, x1, y1), offset in zip(self.cores(width, height), offsets):
+            labels = self.tile_groups(edges, (x0, y0, x1, y1), offset)[1]
+            edges[y0:y1, x0:x1] = linked[components[labels]].view(np.uint8)*np.uint8(255)
+
+        return edges
+
+    def cores(self, width: int, height: int) -> Iterator[Rect]:
+        """ Iterate over the core rectangles of the tiles """
+        for core, padded in self.tiles(width, height):
+            yield core
+
+    @staticmethod
+    def tile_groups(binary: np.ndarray, rect: Rect, offset: int) -> Tuple[int, np.ndarray]:
+        """ Number of labels and labels of the 8-connected groups of a core, offset by `offset`, 0 being empty """
+        x0, y0, x1, y1 = rect
+        count, labels = cv2.connectedComponents((binary[y0:y1, x0:x1] > 0).view(np.uint8), connectivity=8)
+        labels[labels > 0] += offset
+        return count, labels
+
+    @staticmethod
+    def merge(seams: List[np.ndarray], count: int) -> np.ndarray:
+        """
+        Merged label of the labels 0 to `count`, from the (2, N) labels on both sides of each seam.
+
+        The labels that touch (8-connected) across a seam are merged, the background staying 0.
+        """
+        pairs = []
+        for before, after in seams:
+            pairs += [(before, after), (before[:-1], after[1:]), (before[1:], after[:-1])]
+
+        a = np.concatenate([a for a, b in pairs]) if pairs else np.empty(0, dtype=np.int32)
+        b = np.concatenate([b for a, b in pairs]) if pairs else np.empty(0, dtype=np.int32)
+        touching = (a > 0) & (b > 0)
+        graph = coo_matrix((np.ones(touching.sum()), (a[touching], b[touching])), shape=(count + 1, count + 1))
+        count, components = connected_components(graph, directed=False)
+
+        components = components - components[0]  # The background component becomes 0
+        components[components < 0] += count
+        return components.astype(np.int32)
+
+    def iter_contours(self, img: np.ndarray, spec: FilterSpec, matrix: Optional[np.ndarray] = None,
+                      size: Optional[Tuple[int, int]] = None) -> Iterator[Tuple[Rect, np.ndarray]]:
+        """ Iterate over the core rectangles with the (x, y) contour pixels inside """
+        width, height = size or img.shape[1::-1]
+        otsu, edges = None, None
+        if spec.contour in (ContourOptions.OTSUS, ContourOptions.OTSUS_GAUSSIAN_BLUR):
+            otsu = self.otsu(img, spec, matrix, size)
+        elif spec.contour == ContourOptions.CANNY:
+            edges = self.canny(img, spec, matrix, size)
+
+        for (x0, y0, x1, y1), (px0, py0, px1, py1) in self.tiles(width, height):
+            if edges is None:
+                gray = self.gray_tile(self.source_tile(img, (px0, py0, px1, py1), matrix))
+                binary = self.binary_tile(gray, spec, otsu)
+            else:
+                binary = np.ascontiguousarray(edges[py0:py1, px0:px1])
+            pts, labels = contour_points(find_contours(binary))
+            pts = pts + (px0, py0)
+
+            inside = (pts[:, 0] >= x0) & (pts[:, 0] < x1) & (pts[:, 1] >= y0) & (pts[:, 1] < y1)
+            yield (x0, y0, x1, y1), pts[inside]
+
+    def contour_mask(self, img: np.ndarray, spec: FilterSpec, matrix: Optional[np.ndarray] = None,
+                     size: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        """
+        Same as engine.contour_mask, the image being rotated by `matrix` on the fly if given.
+
+        The (width, height) `size` of the rotated image is the one of the image by default.
+        """
+        width, height = size or img.shape[1::-1]
+        mask = np.zeros((height, width), dtype=np.uint8)
+
+        if spec.mode == FilterMode.COLORS:
+            for (x0, y0, x1, y1), padded in self.tiles(width, height):
+                tile = self.source_tile(img, (x0, y0, x1, y1), matrix)
+                mask[y0:y1, x0:x1] = color_mask(tile, spec.color, spec.thresh)
+            return mask
+
+        for rect, pts in self.iter_contours(img, spec, matrix, size):
+            mask[pts[:, 1], pts[:, 0]] = 255
+
+        return mask
+
+    def contour_labels(self, img: np.ndarray, spec: FilterSpec, matrix: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Label image of the 8-connected groups of contour pixels, 0 being the background.
+
+        The groups split by the tiles are stitched back under a single label.
+        """
+        height, width = img.shape[:2]
+        labels = np.zeros((height, width), dtype=np.int32)
+        count = 0
+        for (x0, y0, x1, y1), pts in self.iter_contours(img, spec, matrix):
+            core = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            core[pts[:, 1] - y0, pts[:, 0] - x0] = 1
+            tile_count, tile_labels = cv2.connectedComponents(core, connectivity=8)
+            labels[y0:y1, x0:x1] = np.where(tile_labels > 0, tile_labels + count, 0)
+            count += tile_count - 1
+
+        return self.stitch(labels, count)
+
+    def stitch(self, labels: np.ndarray, count: int) -> np.ndarray:
+        """ Merge the labels of the contour pixels that touch (8-connected) across the tile edges """
+        height, width = labels.shape
+        seams = [labels[:, seam - 1:seam + 1].T for seam in range(self.tile_size, width, self.tile_size)]
+        seams += [labels[seam - 1:seam + 1] for seam in range(self.tile_size, height, self.tile_size)]
+        return self.merge(seams, count)[labels]
+
+    def color_contours(self, img: np.ndarray, spec: FilterSpec, matrix: Optional[np.ndarray] = None) -> np.ndarray:
+        """ Same as engine.color_contours, each stitched group of contour pixels having its own color """
+        labels = self.contour_labels(img, spec, matrix)
+        colored = CONTOUR_COLORS[labels % len(CONTOUR_COLORS)]
+        colored[labels == 0] = 0
+        return colored
+
+    def pixels(self, mask: np.ndarray, selection: Optional[np.ndarray] = None) -> np.ndarray:
+        """ Same as engine.extract_pixels, a band of rows at a time """
+        bands = []
+        for y0 in range(0, mask.shape[0], self.tile_size):
+            band = mask[y0:y0 + self.tile_size] > 0
+            if selection is not None:
+                band &= selection[y0:y0 + self.tile_size] > 0
+            bands.append(mask_pixels(band) + (0, y0))
+
+        return np.concatenate(bands) if bands else np.empty((0, 2), dtype=np.intp)
@@ -1,5 +1,6 @@
-from typing import Union, List, Tuple
-from numpy import ndarray, array
+from typing import Union, List, Tuple, Dict, Optional, Iterator
+from numpy import ndarray, array, asarray, ascontiguousarray, empty, power, log10, hstack, zeros, unique, bincount, \
+    lexsort, floor, column_stack, hypot, argmax, argsort, cumsum
 from .constants import *
 from enum import Enum
 import math as mt
@@ -24,7 +25,7 @@ class CurveFinder:
     def set_coord_points(self, coords: ndarray) -> None:
         self.x1_graph, self.x2_graph, self.y1_graph, self.y2_graph = coords
 
-    def set_axis_points(self, pts: List[Tuple[int, int]]) -> None:
+    def set_axis_points(self, pts: List[Tuple[float, float]]) -> None:
         self.graph.x_axis.pts = ((pts[0][0], pts[0][1]), (pts[1][0], pts[1][1]))
         self.graph.y_axis.pts = ((pts[2][0], pts[2][1]), (pts[3][0], pts[3][1]))
         self.graph.update()
@@ -65,6 +66,13 @@ class CurveFinder:
     def get_points(self) -> Tuple[Tuple[float, float], ...]:
         return self.graph.get_points()
 
+    def to_dict(self) -> dict:
+        """ Return the calibration with the same keys as a batch manifest """
+        return {"axis_pixels": [[float(v) for v in pt] for pt in (*self.graph.x_axis.pts, *self.graph.y_axis.pts)],
+                "axis_values": [float(self.x1_graph), float(self.x2_graph), float(self.y1_graph),
+                                float(self.y2_graph)],
+                "x_scale": "lin" if self.x_is_lin else "log", "y_scale": "lin" if self.y_is_lin else "log"}
+
     def pixel_to_graph(self, pt: tuple) -> ndarray:
         """ Method to convert a pixel coordinate to a graph coordinate """
         x, y = pt
@@ -79,6 +87,26 @@ class CurveFinder:
 
         return array([a, b])
 
+    def pixels_to_graph(self, pts: ndarray) -> ndarray:
+        """ Method to convert an (N, 2) array of pixel coordinates to a contiguous array of graph coordinates """
+        pts = asarray(pts, dtype=float).reshape(-1, 2)
+        graph = empty(pts.shape, dtype=float)
+
+        x, y = graph[:, 0], graph[:, 1]  # Views, the operations below are done in place
+        x[:] = pts[:, 0]
+        x *= self.dx_pixel_to_graph
+        x += self.cx
+        if not self.x_is_lin:
+            power(10, x, out=x)
+
+        y[:] = pts[:, 1]
+        y *= self.dy_pixel_to_graph
+        y += self.cy
+        if not self.y_is_lin:
+            power(10, y, out=y)
+
+        return graph
+
     class Graph:
         axis_corner: Tuple[float, float]
 
@@ -152,7 +180,143 @@ class CurveFinder:
                     self.angle = mt.atan(-1/self.slope)
 
 
-def get_copy_text(mode: CopyOptions, var: str, coefs: list, pts: List[ndarray]) -> Union[str, None]:
+class PointSet:
+    """ Set of points stored as contiguous (N, 2) arrays, in pixel and in graph coordinates """
+
+    def __init__(self, graph: ndarray, pixels: Optional[ndarray] = None) -> None:
+        self._graph = self._freeze(ascontiguousarray(graph, dtype=float).reshape(-1, 2))
+        if pixels is not None:
+            pixels = asarray(pixels)
+            pixels = ascontiguousarray(pixels, dtype=float if pixels.dtype.kind == "f" else int).reshape(-1, 2)
+        self._pixels = None if pixels is None else self._freeze(pixels)  # Aggregated pixels are not integers
+        self._views: Dict[tuple, ndarray] = {}
+
+    @classmethod
+    def from_pixels(cls, curvefinder: CurveFinder, pixels: ndarray) -> "PointSet":
+        """ Create the set from pixel coordinates, the graph coordinates being computed with the CurveFinder """
+        return cls(curvefinder.pixels_to_graph(pixels), pixels)
+
+    @staticmethod
+    def _freeze(arr: ndarray) -> ndarray:
+        arr.flags.writeable = False  # The cached views rely on the data never changing
+        return arr
+
+    def __len__(self) -> int:
+        return len(self._graph)
+
+    def __iter__(self):
+        return iter(self._graph)
+
+    @property
+    def graph(self) -> ndarray:
+        """ The (N, 2) graph coordinates """
+        return self._graph
+
+    @property
+    def pixels(self) -> Optional[ndarray]:
+        """ The (N, 2) pixel coordinates """
+        return self._pixels
+
+    def column(self, axis: int, log: bool = False) -> ndarray:
+        """ Contiguous copy of a graph coordinate column, in log10 if asked, computed once """
+        key = ("column", axis, log)
+        if key not in self._views:
+            col = ascontiguousarray(self._graph[:, axis])
+            self._views[key] = self._freeze(log10(col) if log else col)
+        return self._views[key]
+
+    def pairs(self) -> ndarray:
+        """ The (N, 4) array of the pixel coordinates followed by the graph coordinates, computed once """
+        if "pairs" not in self._views:
+            self._views["pairs"] = self._freeze(hstack((self._pixels, self._graph)))
+        return self._views["pairs"]
+
+    def remap(self, curvefinder: CurveFinder) -> "PointSet":
+        """ Recompute the graph coordinates from the pixels, e.g. after a change of lin/log axis """
+        return PointSet.from_pixels(curvefinder, self._pixels)
+
+    def reduce(self, aggregation: Aggregation = Aggregation.ALL, bin_width: float = 0, epsilon: float = 0,
+               y_from_x: bool = True, x_is_log: bool = False, y_is_log: bool = False) -> "PointSet":
+        """
+        Reduced set of points for the fit, computed once per set of parameters.
+
+        The points are aggregated (median or centroid of the dependent coordinate) per bin of the independent one, a bin
+        being a pixel column or `bin_width` wide in the fitted space (decades on a log axis). The result is then
+        simplified with Ramer-Douglas-Peucker with a tolerance of `epsilon` pixels.
+        """
+        key = ("reduce", Aggregation(aggregation), bin_width, epsilon, y_from_x, x_is_log, y_is_log)
+        if key not in self._views:
+            if aggregation == Aggregation.ALL and epsilon <= 0 or len(self) == 0:
+                reduced = self
+            else:
+                reduced = self._reduce(aggregation, bin_width, epsilon, y_from_x, x_is_log, y_is_log)
+            self._views[key] = reduced
+        return self._views[key]
+
+    def _reduce(self, aggregation: Aggregation, bin_width: float, epsilon: float, y_from_x: bool, x_is_log: bool,
+                y_is_log: bool) -> "PointSet":
+        ind, dep = (0, 1) if y_from_x else (1, 0)
+        fitted = column_stack((self.column(0, x_is_log), self.column(1, y_is_log)))
+        pixels = self._pixels if self._pixels is not None else fitted
+
+        # Bins of the independent coordinate
+        if bin_width > 0:
+            bins = floor((fitted[:, ind] - fitted[:, ind].min())/bin_width)
+        else:
+            bins = pixels[:, ind]
+        bins, inverse = unique(bins, return_inverse=True)
+
+        if aggregation == Aggregation.ALL:
+            order = argsort(inverse, kind="stable")
+            fitted, pixels = fitted[order], pixels[order]
+        else:
+            counts = bincount(inverse)
+            fitted_out, pixels_out = empty((len(bins), 2)), empty((len(bins), 2))
+            for out, values in ((fitted_out, fitted), (pixels_out, pixels)):
+                out[:, ind] = bincount(inverse, values[:, ind])/counts
+                if aggregation == Aggregation.CENTROID:
+                    out[:, dep] = bincount(inverse, values[:, dep])/counts
+                else:  # Median, the mapping of a pixel to the fitted space keeps or reverses the order
+                    sorted_dep = values[lexsort((values[:, dep], inverse)), dep]
+                    starts = cumsum(counts) - counts
+                    out[:, dep] = (sorted_dep[starts + (counts - 1)//2] + sorted_dep[starts + counts//2])/2
+            fitted, pixels = fitted_out, pixels_out
+
+        if epsilon > 0:
+            keep = rdp_mask(pixels, epsilon)
+            fitted, pixels = fitted[keep], pixels[keep]
+
+        if x_is_log:
+            fitted[:, 0] = power(10, fitted[:, 0])
+        if y_is_log:
+            fitted[:, 1] = power(10, fitted[:, 1])
+        return PointSet(fitted, None if self._pixels is None else pixels.astype(float))
+
+
+def rdp_mask(pts: ndarray, epsilon: float) -> ndarray:
+    """ Mask of the points of a polyline kept by the Ramer-Douglas-Peucker simplification """
+    keep = zeros(len(pts), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(pts) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+
+        seg = pts[i + 1:j] - pts[i]
+        dx, dy = pts[j] - pts[i]
+        norm = hypot(dx, dy)
+        dist = abs(dx*seg[:, 1] - dy*seg[:, 0])/norm if norm > 0 else hypot(seg[:, 0], seg[:, 1])
+        k = int(argmax(dist))
+        if dist[k] > epsilon:
+            k += i + 1
+            keep[k] = True
+            stack += [(i, k), (k, j)]
+
+    return keep
+
+
+def get_copy_text(mode: CopyOptions, var: str, coefs: list, pts: Union[PointSet, ndarray]) -> Union[str, None]:
     order = len(coefs) - 1
     equation = ""
 
@@ -247,135 +411,61 @@ def get_copy_text(mode: CopyOptions, var: str, coefs: list, pts: List[ndarray])
         equation = equation.replace(".", ",")
         return equation
 
-    elif mode == CopyOptions.POINTS_MATLAB:
-        text = "x = ["
-        x_r = []
-        y_r = []
+    elif mode in STREAMED_COPY_OPTIONS:
+        return "".join(iter_copy_text(mode, var, coefs, pts))
 
-        for d in pts:
-            x_r.append(d[0])
-            y_r.append(d[1])
-
-        for (i, x) in enumerate(x_r):
-            if i == 0:
-                text += f"{x}"
-            else:
-                text += f" {x}"
-
-        text += "];\ny = ["
-        for (i, y) in enumerate(y_r):
-            if i == 0:
-                text += f"{y}"
-            else:
-                text += f" {y}"
-
-        text += "];"
+    else:
+        return None
 
-        return text
 
-    elif mode == CopyOptions.POINTS_PYTHON:
-        text = "x = ["
-        x_r = []
-        y_r = []
+def iter_values(values: ndarray, sep: str, chunk: int = EXPORT_CHUNK) -> Iterator[str]:
+    """ Format the values separated by `sep`, a chunk at a time """
+    for i in range(0, len(values), chunk):
+        yield (sep if i else "") + sep.join(map(str, values[i:i + chunk].tolist()))
 
-        for d in pts:
-            x_r.append(d[0])
-            y_r.append(d[1])
 
-        for (i, x) in enumerate(x_r):
-            if i == 0:
-                text += f"{x}"
-            else:
-                text += f", {x}"
+def iter_copy_text(mode: CopyOptions, var: str, coefs: list, pts: Union[PointSet, ndarray]) -> Iterator[str]:
+    """
+    Same text as `get_copy_text`, in pieces that can be written to a file as they come.
 
-        text += "];\ny = ["
-        for (i, y) in enumerate(y_r):
-            if i == 0:
-                text += f"{y}"
-            else:
-                text += f", {y}"
+    The points and the coefficients are formatted by chunks, so the time is linear in the number of points and the
+    memory is bounded by the chunk size. Nothing is yielded for an unknown mode.
+    """
+    if mode not in STREAMED_COPY_OPTIONS:
+        text = get_copy_text(mode, var, coefs, pts)
+        if text is not None:
+            yield text
+        return
 
-        text += "];"
+    pts = pts.graph if isinstance(pts, PointSet) else asarray(pts, dtype=float).reshape(-1, 2)
+    coefs = asarray(coefs, dtype=float)
 
-        return text
+    if mode in (CopyOptions.POINTS_MATLAB, CopyOptions.POINTS_PYTHON):
+        sep = " " if mode == CopyOptions.POINTS_MATLAB else ", "
+        yield "x = ["
+        yield from iter_values(pts[:, 0], sep)
+        yield "];\ny = ["
+        yield from iter_values(pts[:, 1], sep)
+        yield "];"
 
     elif mode == CopyOptions.POINTS_NUMPY:
-        text = "pts = np.array([["
-        x_r = []
-        y_r = []
-
-        for d in pts:
-            x_r.append(d[0])
-            y_r.append(d[1])
-
-        for (i, x) in enumerate(x_r):
-            if i == 0:
-                text += f"{x}"
-            else:
-                text += f", {x}"
-
-        text += "], ["
-        for (i, y) in enumerate(y_r):
-            if i == 0:
-                text += f"{y}"
-            else:
-                text += f", {y}"
-
-        text += "]])"
-
-        return text
+        yield "pts = np.array([["
+        yield from iter_values(pts[:, 0], ", ")
+        yield "], ["
+        yield from iter_values(pts[:, 1], ", ")
+        yield "]])"
 
     elif mode == CopyOptions.POINTS_CSV:
-        text = "x, y\n"
-
-        for d in pts:
-            text += f"{d[0]}, {d[1]}\n"
-
-        return text
-
-    elif mode == CopyOptions.COEFFS_MATLAB:
-        text = "["
-        for (i, coef) in enumerate(coefs):
-            if i == 0:
-                text += f"{coef}"
-            else:
-                text += f" {coef}"
-        text += "]"
-
-        return text
-
-    elif mode == CopyOptions.COEFFS_PYTHON:
-        text = "["
-        for (i, coef) in enumerate(coefs):
-            if i == 0:
-                text += f"{coef}"
-            else:
-                text += f", {coef}"
-        text += "]"
-
-        return text
-
-    elif mode == CopyOptions.COEFFS_NUMPY:
-        text = "np.array(["
-        for (i, coef) in enumerate(coefs):
-            if i == 0:
-                text += f"{coef}"
-            else:
-                text += f", {coef}"
-        text += "])"
-
-        return text
-
-    elif mode == CopyOptions.POLY1D:
-        text = "p = np.poly1d(["
-        for (i, coef) in enumerate(coefs):
-            if i == 0:
-                text += f"{coef}"
-            else:
-                text += f", {coef}"
-        text += "])"
-
-        return text
+        yield "x, y\n"
+        for i in range(0, len(pts), EXPORT_CHUNK):
+            chunk = pts[i:i + EXPORT_CHUNK]
+            yield "".join(map("{}, {}\n".format, chunk[:, 0].tolist(), chunk[:, 1].tolist()))
 
     else:
-        return None
+        prefix, sep, suffix = {CopyOptions.COEFFS_MATLAB: ("[", " ", "]"),
+                               CopyOptions.COEFFS_PYTHON: ("[", ", ", "]"),
+                               CopyOptions.COEFFS_NUMPY: ("np.array([", ", ", "])"),
+                               CopyOptions.POLY1D: ("p = np.poly1d([", ", ", "])")}[mode]
+        yield prefix
+        yield from iter_values(coefs, sep)
+        yield suffix
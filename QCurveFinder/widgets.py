@@ -1,9 +1,11 @@
 from PyQt5.QtWidgets import QLabel, QHBoxLayout, QVBoxLayout, QPushButton, QCheckBox, QLineEdit, QTextBrowser, \
-    QSlider, QComboBox, QRadioButton, QSpinBox, QButtonGroup, QTabWidget, QWidget, QColorDialog
-from PyQt5.QtGui import QPixmap, QMouseEvent, QFont, QPainter, QPainterPath, QPen, QColor, QTextDocument
-from PyQt5.QtCore import Qt, pyqtSignal, QPoint, QRect, QSize, QRectF, QSizeF
+    QSlider, QComboBox, QRadioButton, QSpinBox, QDoubleSpinBox, QButtonGroup, QTabWidget, QWidget, QColorDialog, QStyle
+from PyQt5.QtGui import QPixmap, QMouseEvent, QFont, QPainter, QPainterPath, QPen, QColor, QTextDocument, QPaintEvent
+from PyQt5.QtCore import Qt, pyqtSignal, QPoint, QRect, QSize, QRectF, QSizeF, QPointF, QEvent
+from PyQt5 import QtGui, sip
 
-from typing import List, Tuple
+from typing import List, Tuple, Union
+import numpy as np
 
 from .constants import *
 
@@ -43,6 +45,31 @@ class QCoordBox(QHBoxLayout):
         self.setParent(None)
 
 
+def array_to_qimage(img: np.ndarray, rgb: bool = False) -> QtGui.QImage:
+    """
+    Wrap a gray, BGR or BGRA (RGB or RGBA if `rgb`) image array in a QImage sharing its buffer.
+
+    The rows only need to be contiguous, so a crop of a larger image is not copied either. The QImage does not own
+    the buffer, so it keeps a reference to the array for as long as it lives.
+    """
+    img = np.asarray(img)
+    if img.dtype != np.uint8 or img.strides[0] < 0 or img.strides[-1] != 1 or \
+            (img.ndim == 3 and img.strides[1] != img.shape[2]):
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+
+    height, width = img.shape[:2]
+    if img.ndim == 2:
+        img_format = QtGui.QImage.Format_Grayscale8
+    elif img.shape[2] == 3:
+        img_format = QtGui.QImage.Format_RGB888 if rgb else QtGui.QImage.Format_BGR888
+    else:
+        img_format = QtGui.QImage.Format_RGBA8888 if rgb else QtGui.QImage.Format_ARGB32  # ARGB32 is BGRA in memory
+
+    q_img = QtGui.QImage(sip.voidptr(img.ctypes.data), width, height, img.strides[0], img_format)
+    q_img.array = img  # The buffer must outlive the image
+    return q_img
+
+
 class QImage(QLabel):
     """ The class for the big image box """
 
@@ -50,6 +77,7 @@ class QImage(QLabel):
     zoom = 2
     radius = 60
     border: int = 3
+    mask_color: QColor = QColor(255, 0, 0, 100)
     pts_colors: Tuple[QColor] = (QColor(204, 0, 0, 150), QColor(0, 153, 0, 150),
                                  QColor(0, 0, 153, 150), QColor(204, 204, 0, 150))
     pts_labels: Tuple[str] = ("<p style='color:rgba(204, 0, 0, 150)'>X<sub>1</sub></p>",
@@ -57,14 +85,15 @@ class QImage(QLabel):
                               "<p style='color:rgba(0, 0, 153, 150)'>Y<sub>1</sub></p>",
                               "<p style='color:rgba(204, 204, 0, 150)'>Y<sub>2</sub></p>")
 
-    def __init__(self, image_path: str) -> None:
+    def __init__(self, image: Union[str, np.ndarray]) -> None:
         """ Initialise the image of the graph """
         super().__init__()
 
-        self.source: str = image_path  # Set the image
+        self.cursor_pos: Union[QPoint, None] = None
+        self.source = image  # Set the image
 
         self.clickEnabled: bool = False
-        self.zoomEnabled: bool = False
+        self.zoomEnabled = False
         self.maskEnabled = False
         self.coordEnabled = False
         self.holding: bool = False
@@ -73,9 +102,6 @@ class QImage(QLabel):
 
         self.setStyleSheet(f"border: {self.border}px solid gray;")  # Add borders
 
-        self.base_pixmap: QPixmap = None
-        self.updated_pixmap: QPixmap = None
-
         self.brush_radius: int = 5
         self.pts: List[QPoint, QPoint, QPoint, QPoint] = [None, None, None, None]
 
@@ -136,58 +162,101 @@ class QImage(QLabel):
             self.num_printed_coord += 1
 
     def add_mask(self, x: int, y: int) -> None:
-        rectangle = QRect(QPoint(x - self.brush_radius, y - self.brush_radius),
-                          2*self.brush_radius*QSize(1, 1))
-        overlay_pixmap = self.base_pixmap.copy(rectangle)
-        crosshair_pixmap = self.base_pixmap.copy(rectangle)
-
-        # If holding, add the mask
-        if self.holding and self.button == Qt.MouseButton.LeftButton or self.button == Qt.MouseButton.RightButton:
-            brush_painter = QPainter(overlay_pixmap)
+        """ Paint the brush on the mask layer when holding and move the brush cursor """
+        if self.holding and self.button in (Qt.MouseButton.LeftButton, Qt.MouseButton.RightButton):
+            painter = QPainter(self.mask_pixmap)
+            painter.setRenderHints(QPainter.Antialiasing)
+            painter.setPen(Qt.NoPen)
             if self.button == Qt.MouseButton.LeftButton:
-                pen = QPen(QColor(255, 0, 0, 100), 3*self.brush_radius)
-            elif self.button == Qt.MouseButton.RightButton:
-                pen = QPen(QColor(255, 0, 0, 0), 3*self.brush_radius)
-            brush_painter.setPen(pen)
-            brush_painter.drawPoint(overlay_pixmap.rect().center())
-            brush_painter.end()
-
-        # Add a contour to visualize where you paint
-        crosshair_painter = QPainter(crosshair_pixmap)
-        if self.holding and self.button == Qt.MouseButton.LeftButton:
-            pen = QPen(QColor(255, 0, 0, 100), 3*self.brush_radius)
-            crosshair_painter.setPen(pen)
-            crosshair_painter.drawPoint(overlay_pixmap.rect().center())
-        crosshair_painter.setPen(QPen(QColor(255, 255, 255, 80), 3))
-        crosshair_painter.drawEllipse(crosshair_pixmap.rect())
-        crosshair_painter.end()
+                painter.setCompositionMode(QPainter.CompositionMode_Source)
+                painter.setBrush(self.mask_color)
+            else:
+                painter.setCompositionMode(QPainter.CompositionMode_Clear)
+                painter.setBrush(Qt.black)
+            painter.drawEllipse(QPointF(x, y), self.brush_radius, self.brush_radius)
+            painter.end()
 
-        path = QPainterPath()
-        rectangle = QRectF(QPoint(x - self.brush_radius, y - self.brush_radius), 2*self.brush_radius*QSizeF(1, 1))
-        path.addEllipse(rectangle)
+        self.move_cursor(QPoint(x, y))
 
-        # If holding, add the mask to the updated pixmap
-        if self.holding:
-            mask_painter = QPainter(self.updated_pixmap)
-            mask_painter.setRenderHints(QPainter.Antialiasing | QPainter.SmoothPixmapTransform)
-            mask_painter.setClipPath(path, Qt.IntersectClip)
-            mask_painter.drawPixmap(QPoint(x - self.brush_radius, y - self.brush_radius), overlay_pixmap)
-            mask_painter.end()
+    def set_mask(self, mask: np.ndarray) -> None:
+        """ Replace the mask layer by the non-zero pixels of an array of the size of the image """
+        layer = np.zeros(mask.shape[:2] + (4,), dtype=np.uint8)
+        layer[mask > 0] = self.mask_color.getRgb()
+        self.mask_pixmap = QPixmap.fromImage(array_to_qimage(layer, rgb=True))
+        self.update()
 
-        # Add the crosshair to the pixmap
-        rendered_pixmap = self.updated_pixmap.copy()
-        final_crosshair_painter = QPainter(rendered_pixmap)
-        final_crosshair_painter.setRenderHints(QPainter.Antialiasing | QPainter.SmoothPixmapTransform)
-        final_crosshair_painter.setClipPath(path, Qt.IntersectClip)
-        final_crosshair_painter.drawPixmap(QPoint(x - self.brush_radius, y - self.brush_radius), crosshair_pixmap)
-        final_crosshair_painter.end()
+    def add_zoom(self, x: int, y: int) -> None:
+        """ Move the magnifying glass """
+        self.move_cursor(QPoint(x, y))
+
+    def move_cursor(self, pos: Union[QPoint, None]) -> None:
+        """ Move the cursor layer and repaint only the regions it left and entered """
+        dirty = self.cursor_rect()
+        self.cursor_pos = pos
+        dirty = dirty.united(self.cursor_rect())
+        if not dirty.isEmpty():
+            self.update(dirty.translated(self.image_origin()))
+
+    def cursor_rect(self) -> QRect:
+        """ Rectangle covered by the cursor layer, in image coordinates """
+        rect = QRect()
+        if self.cursor_pos is None:
+            return rect
+
+        x, y = self.cursor_pos.x(), self.cursor_pos.y()
+        if self.maskEnabled:
+            rect = rect.united(QRect(x - self.brush_radius, y - self.brush_radius,
+                                     2*self.brush_radius, 2*self.brush_radius))
+        if self.zoomEnabled:
+            rect = rect.united(QRect(x, y, self.zoom*self.radius, self.zoom*self.radius))
 
-        self.setPixmap(rendered_pixmap)
+        return rect.adjusted(-2, -2, 2, 2)  # Margin for the antialiasing and the pens
 
-    def add_zoom(self, x: int, y: int) -> None:
-        base_pixmap = self.base_pixmap.copy()
-        rectangle = QRect(QPoint(x - self.radius/2, y - self.radius/2), self.radius*QSize(1, 1))
-        overlay_pixmap = base_pixmap.copy(rectangle).scaledToWidth(self.zoom*self.radius, Qt.SmoothTransformation)
+    def image_origin(self) -> QPoint:
+        """ Position of the top left corner of the image in the widget """
+        return QStyle.alignedRect(self.layoutDirection(), self.alignment(), self.base_pixmap.size(),
+                                  self.contentsRect()).topLeft()
+
+    def leaveEvent(self, ev: QEvent) -> None:
+        """ Event when the mouse leaves the image """
+        self.move_cursor(None)
+
+    def paintEvent(self, ev: QPaintEvent) -> None:
+        """ Paint the base image, then the mask and the cursor layers, only over the dirty region """
+        super().paintEvent(ev)
+
+        painter = QPainter(self)
+        painter.setRenderHints(QPainter.Antialiasing | QPainter.SmoothPixmapTransform)
+        painter.translate(self.image_origin())
+
+        if self.maskEnabled:
+            dirty = ev.rect().translated(-self.image_origin()).intersected(self.mask_pixmap.rect())
+            painter.drawPixmap(dirty, self.mask_pixmap, dirty)
+
+        if self.cursor_pos is not None:
+            if self.maskEnabled:
+                self.paint_brush(painter, self.cursor_pos.x(), self.cursor_pos.y())
+            if self.zoomEnabled:
+                self.paint_zoom(painter, self.cursor_pos.x(), self.cursor_pos.y())
+
+        painter.end()
+
+    def paint_brush(self, painter: QPainter, x: int, y: int) -> None:
+        """ Paint the contour of the brush to visualize where you paint """
+        rectangle = QRectF(QPoint(x - self.brush_radius, y - self.brush_radius), 2*self.brush_radius*QSizeF(1, 1))
+        path = QPainterPath()
+        path.addEllipse(rectangle)
+
+        painter.save()
+        painter.setClipPath(path, Qt.IntersectClip)
+        painter.setPen(QPen(QColor(255, 255, 255, 80), 3))
+        painter.drawEllipse(rectangle)
+        painter.restore()
+
+    def paint_zoom(self, painter: QPainter, x: int, y: int) -> None:
+        """ Paint the magnifying glass """
+        rectangle = QRect(QPoint(x - self.radius//2, y - self.radius//2), self.radius*QSize(1, 1))
+        overlay_pixmap = self.base_pixmap.copy(rectangle).scaledToWidth(self.zoom*self.radius, Qt.SmoothTransformation)
 
         crosshair = QPainter(overlay_pixmap)
         crosshair.setPen(QPen(Qt.white, 3))
@@ -202,13 +271,10 @@ class QImage(QLabel):
         path = QPainterPath()
         path.addEllipse(rectangle_zoomed)
 
-        painter = QPainter(base_pixmap)
-        painter.setRenderHints(QPainter.Antialiasing | QPainter.SmoothPixmapTransform)
+        painter.save()
         painter.setClipPath(path, Qt.IntersectClip)
         painter.drawPixmap(QPoint(x, y), overlay_pixmap)
-        painter.end()
-
-        self.setPixmap(base_pixmap)
+        painter.restore()
 
     def draw_points(self, pts: Tuple[Tuple[float, float], ...]) -> None:
         for i, pt in enumerate(pts):
@@ -246,6 +312,17 @@ class QImage(QLabel):
     def get_xy_from_event(self, ev: QMouseEvent) -> Tuple[int, int]:
         return ev.x() - self.border, ev.y() + self.border
 
+    @property
+    def zoomEnabled(self) -> bool:
+        """ Return if zoomEnabled is true or not """
+        return self._zoomEnabled
+
+    @zoomEnabled.setter
+    def zoomEnabled(self, a0: bool) -> None:
+        """ Set the zoomEnabled attribute and remove the magnifying glass if needed """
+        self._zoomEnabled = a0
+        self.update()
+
     @property
     def maskEnabled(self) -> bool:
         """ Return if maskEnable is true or not """
@@ -253,9 +330,10 @@ class QImage(QLabel):
 
     @maskEnabled.setter
     def maskEnabled(self, a0: bool) -> None:
-        """ Set the maskEnable attribute """
+        """ Set the maskEnable attribute and clear the mask layer """
         self._maskEnabled = a0
-        self.updated_pixmap = self.source.copy()
+        self.mask_pixmap.fill(Qt.transparent)
+        self.update()
 
     @property
     def coordEnabled(self) -> bool:
@@ -266,7 +344,6 @@ class QImage(QLabel):
     def coordEnabled(self, a0: bool) -> None:
         """ Set the coordEnable attribute """
         self._coordEnabled = a0
-        self.updated_pixmap = self.source.copy()
         self.num_printed_coord = 0
 
     @property
@@ -275,15 +352,22 @@ class QImage(QLabel):
         return self._source
 
     @source.setter
-    def source(self, src: str) -> None:
-        """ Set the image and resize it to fit in the box """
-        self.img_path = src  # Save the path
-        new_img = QPixmap(src)  # Load the image
+    def source(self, src: Union[str, np.ndarray, QtGui.QImage]) -> None:
+        """ Set the image, from a path, an array or a QImage, and resize it to fit in the box """
+        if isinstance(src, str):
+            new_img = QPixmap(src)  # Load the image
+        else:
+            if isinstance(src, np.ndarray):
+                src = array_to_qimage(src)
+            if src.width() > MAX_IMG_W or src.height() > MAX_IMG_H:
+                src = src.scaled(MAX_IMG_W, MAX_IMG_H, Qt.KeepAspectRatio)  # Only the scaled image is copied
+            new_img = QPixmap.fromImage(src)
         self._source = new_img.scaled(MAX_IMG_W, MAX_IMG_H, Qt.KeepAspectRatio)  # Save the rescaled source image
         self.image_size = (self._source.height(), self._source.width())
-        self._source.save(src)  # Save the resized image
         self.setPixmap(self._source)  # Display the image
         self.base_pixmap = self._source.copy()
+        self.mask_pixmap = QPixmap(self._source.size())  # Transparent layer of the painted mask
+        self.mask_pixmap.fill(Qt.transparent)
 
 
 class QInstructBox(QVBoxLayout):
@@ -339,7 +423,7 @@ class QCoordOption(QOptionsTemplate):
         super().__init__("Coordinates :")
 
         # Init the pts and them characteristics
-        self.pts: List[Tuple[int, int]] = [(-1, -1)]*4
+        self.pts: List[Tuple[float, float]] = [(-1, -1)]*4
 
         # Create the widgets
         self.x1_coord: QCoordBox = QCoordBox(self.pts_labels[0])
@@ -347,12 +431,26 @@ class QCoordOption(QOptionsTemplate):
         self.y1_coord: QCoordBox = QCoordBox(self.pts_labels[2])
         self.y2_coord: QCoordBox = QCoordBox(self.pts_labels[3])
 
+        self.label_template: QNewLabel = QNewLabel(text="Template :")
+        self.template: QComboBox = QComboBox()
+        self.refine: QCheckBox = QCheckBox(text="Refine")
+        self.refine.setChecked(True)
+        self.refine.setToolTip("Move the points by matching the features of the template image")
+        self.but_apply_template: QPushButton = QPushButton(text="Apply")
+
         # Create the layout
         self.vbox.addLayout(self.x1_coord)
         self.vbox.addLayout(self.x2_coord)
         self.vbox.addLayout(self.y1_coord)
         self.vbox.addLayout(self.y2_coord)
 
+        hbtemplate = QHBoxLayout()
+        hbtemplate.addWidget(self.label_template)
+        hbtemplate.addWidget(self.template, 1)
+        hbtemplate.addWidget(self.refine)
+        hbtemplate.addWidget(self.but_apply_template)
+        self.vbox.addLayout(hbtemplate)
+
         # Initialise the values
         self.initValues()
 
@@ -420,6 +518,10 @@ class QCoordOption(QOptionsTemplate):
         self.x2_coord.delete()
         self.y1_coord.delete()
         self.y2_coord.delete()
+        self.label_template.delete()
+        self.template.setParent(None)
+        self.refine.setParent(None)
+        self.but_apply_template.setParent(None)
         super().delete()
 
 
@@ -561,10 +663,21 @@ class QFilterOption(QOptionsTemplate):
         self.tabs.addTab(self.pages[1], "Colors")
         self.vbox.addWidget(self.tabs)
 
+        self.plot_area: QCheckBox = QCheckBox(text="Only in the plot area")
+        self.plot_area.setChecked(True)
+        self.vbox.addWidget(self.plot_area)
+
+        self.roi: QLineEdit = QLineEdit()
+        self.roi.setPlaceholderText("Region : x, y, w, h or x1, y1; x2, y2; ...")
+        self.roi.setToolTip("Rectangle or polygon filtered instead of the plot area, in pixels of the rotated image")
+        self.vbox.addWidget(self.roi)
+
     def delete(self) -> None:
         self.contours.delete()
         self.colors.delete()
         self.tabs.setParent(None)
+        self.plot_area.setParent(None)
+        self.roi.setParent(None)
         super().delete()
 
 
@@ -600,6 +713,10 @@ class QEvaluationOptions(QOptionsTemplate):
         self.combo: QComboBox = QComboBox()
         self.combo.addItems(COPY_OPTIONS_TEXT)
         self.but_copy: QPushButton = QPushButton(text="Copy")
+        self.but_save: QPushButton = QPushButton(text="Save")
+        self.export_combo: QComboBox = QComboBox()
+        self.export_combo.addItems(EXPORT_OPTIONS_TEXT)
+        self.but_export: QPushButton = QPushButton(text="Export")
 
         self.label1: QNewLabel = QNewLabel(text="Wanted equation :")
         self.bg_formula: QButtonGroup = QButtonGroup()
@@ -625,11 +742,34 @@ class QEvaluationOptions(QOptionsTemplate):
         self.bg_y.addButton(self.y_lin)
         self.bg_y.addButton(self.y_log)
 
+        self.label6: QNewLabel = QNewLabel("Model :")
+        self.model: QComboBox = QComboBox()
+        self.model.addItems(MODEL_TEXT)
+
         self.label2: QNewLabel = QNewLabel("Fit order :")
         self.spinbox: QSpinBox = QSpinBox()
-        self.spinbox.setRange(0, 15)
+        self.spinbox.setRange(0, FIT_MAX_ORDER)
         self.spinbox.setSingleStep(1)
         self.spinbox.setValue(5)
+        self.auto_order: QCheckBox = QCheckBox(text="Auto")
+        self.auto_order.setToolTip(f"Choose the order with a {FIT_CV_FOLDS}-fold cross-validation")
+        self.auto_order.toggled.connect(lambda checked: self.spinbox.setEnabled(not checked))
+
+        self.label4: QNewLabel = QNewLabel("Points :")
+        self.aggregation: QComboBox = QComboBox()
+        self.aggregation.addItems(AGGREGATION_TEXT)
+        self.bin_width: QDoubleSpinBox = QDoubleSpinBox()
+        self.bin_width.setRange(0, 1e6)
+        self.bin_width.setDecimals(4)
+        self.bin_width.setSpecialValueText("Pixel column")
+        self.bin_width.setToolTip("Width of the bins in graph units (decades on a log. axis)")
+        self.label5: QNewLabel = QNewLabel("Simplify :")
+        self.epsilon: QDoubleSpinBox = QDoubleSpinBox()
+        self.epsilon.setRange(0, 100)
+        self.epsilon.setSingleStep(0.5)
+        self.epsilon.setSpecialValueText("Off")
+        self.epsilon.setSuffix(" px")
+        self.epsilon.setToolTip("Tolerance of the Ramer-Douglas-Peucker simplification")
 
         self.label3: QNewLabel = QNewLabel("Input :")
         self.input: QLineEdit = QLineEdit()
@@ -647,6 +787,11 @@ class QEvaluationOptions(QOptionsTemplate):
         hbcopy = QHBoxLayout()
         hbcopy.addWidget(self.combo)
         hbcopy.addWidget(self.but_copy)
+        hbcopy.addWidget(self.but_save)
+
+        hbexport = QHBoxLayout()
+        hbexport.addWidget(self.export_combo)
+        hbexport.addWidget(self.but_export)
 
         hb0 = QHBoxLayout()
         hb0.addWidget(self.label1)
@@ -664,8 +809,18 @@ class QEvaluationOptions(QOptionsTemplate):
         hb1.addWidget(self.y_log)
 
         hb2 = QHBoxLayout()
+        hb2.addWidget(self.label6)
+        hb2.addWidget(self.model)
         hb2.addWidget(self.label2)
         hb2.addWidget(self.spinbox)
+        hb2.addWidget(self.auto_order)
+
+        hb4 = QHBoxLayout()
+        hb4.addWidget(self.label4)
+        hb4.addWidget(self.aggregation)
+        hb4.addWidget(self.bin_width)
+        hb4.addWidget(self.label5)
+        hb4.addWidget(self.epsilon)
 
         hb3 = QHBoxLayout()
         hb3.addWidget(self.label3)
@@ -674,14 +829,19 @@ class QEvaluationOptions(QOptionsTemplate):
         hb3.addWidget(self.but_evaluate)
 
         self.vbox.addLayout(hbcopy)
+        self.vbox.addLayout(hbexport)
         self.vbox.addLayout(hb0)
         self.vbox.addLayout(hb1)
         self.vbox.addLayout(hb2)
+        self.vbox.addLayout(hb4)
         self.vbox.addLayout(hb3)
 
     def delete(self) -> None:
         self.combo.setParent(None)
         self.but_copy.setParent(None)
+        self.but_save.setParent(None)
+        self.export_combo.setParent(None)
+        self.but_export.setParent(None)
 
         self.label1.delete()
         self.bg_formula.setParent(None)
@@ -698,8 +858,17 @@ class QEvaluationOptions(QOptionsTemplate):
         self.y_lin.setParent(None)
         self.y_log.setParent(None)
 
+        self.label6.delete()
+        self.model.setParent(None)
         self.label2.delete()
         self.spinbox.setParent(None)
+        self.auto_order.setParent(None)
+
+        self.label4.delete()
+        self.aggregation.setParent(None)
+        self.bin_width.setParent(None)
+        self.label5.delete()
+        self.epsilon.setParent(None)
 
         self.label3.delete()
         self.input.setParent(None)
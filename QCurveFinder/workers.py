@@ -0,0 +1,90 @@
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QTimer, pyqtSignal
+
+from typing import Callable, Hashable, Optional, Tuple
+
+from .constants import *
+
+
+class QTaskSignals(QObject):
+    """ Signals of a task, a QRunnable not being a QObject """
+
+    done: pyqtSignal = pyqtSignal(int, object, object)  # Generation, key, result
+
+
+class QTask(QRunnable):
+    """ Task computing a result on a thread of the pool """
+
+    def __init__(self, generation: int, key: Hashable, compute: Callable[[], object], signals: QTaskSignals) -> None:
+        super().__init__()
+        self.generation = generation
+        self.key = key
+        self.compute = compute
+        self.signals = signals
+
+    def run(self) -> None:
+        try:
+            result = self.compute()
+        except Exception as e:  # Reported to the main thread instead of being lost in the pool
+            result = e
+        self.signals.done.emit(self.generation, self.key, result)
+
+
+class QFilterPreviewWorker(QObject):
+    """
+    Compute the filter previews on a worker thread.
+
+    The requests are debounced and only the newest one is kept: a single task runs at a time and the requests made in
+    the meantime replace each other, so a stale result is never drawn and stale computations never pile up.
+    """
+
+    ready: pyqtSignal = pyqtSignal(object, object)  # Key, result
+    error: pyqtSignal = pyqtSignal(object, object)  # Key, exception
+
+    def __init__(self, delay: int = FILTER_PREVIEW_DELAY) -> None:
+        super().__init__()
+        self.generation: int = 0
+        self.running: bool = False
+        self.pending: Optional[Tuple[int, Hashable, Callable[[], object]]] = None
+
+        self.pool: QThreadPool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+
+        self.signals: QTaskSignals = QTaskSignals()
+        self.signals.done.connect(self.finished)
+
+        self.timer: QTimer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.start_pending)
+
+    def request(self, key: Hashable, compute: Callable[[], object]) -> None:
+        """ Ask for a new preview, it starts once no other request came for the debounce delay """
+        self.generation += 1
+        self.pending = (self.generation, key, compute)
+        self.timer.start()
+
+    def cancel(self) -> None:
+        """ Forget the pending request and ignore the result of the running one """
+        self.generation += 1
+        self.pending = None
+        self.timer.stop()
+
+    def start_pending(self) -> None:
+        if self.running or self.pending is None:
+            return  # Started when the running task is done
+
+        generation, key, compute = self.pending
+        self.pending = None
+        self.running = True
+        self.pool.start(QTask(generation, key, compute, self.signals))
+
+    def finished(self, generation: int, key: Hashable, result: object) -> None:
+        """ Slot called in the main thread when a task is done """
+        self.running = False
+        if generation != self.generation:  # Stale result, start the newest request if it is due
+            if not self.timer.isActive():
+                self.start_pending()
+        elif isinstance(result, Exception):  # Raising in a slot would abort the app
+            self.error.emit(key, result)
+        else:
+            self.ready.emit(key, result)
@@ -1,20 +1,32 @@
-from QCurveFinder.application import QCurveFinder
-from PyQt5.QtWidgets import QApplication
+from multiprocessing import freeze_support
+import sys
 
-try:
-    import pyi_splash
-    splash = True
-except ModuleNotFoundError:
-    splash = False
 
-from random import seed
-import sys
+def main() -> int:
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from QCurveFinder.batch import main as batch_main
+        return batch_main(sys.argv[2:])
+
+    from QCurveFinder.application import QCurveFinder
+    from PyQt5.QtWidgets import QApplication
+
+    try:
+        import pyi_splash
+        splash = True
+    except ModuleNotFoundError:
+        splash = False
+
+    from random import seed
+
+    seed(123456)
+    app = QApplication([])
+    window = QCurveFinder()
+    if splash:
+        pyi_splash.close()
+    window.show()
+    return app.exec_()
 
 
-seed(123456)
-app = QApplication([])
-window = QCurveFinder()
-if splash:
-    pyi_splash.close()
-window.show()
-sys.exit(app.exec_())
+if __name__ == "__main__":
+    freeze_support()  # The batch workers start from the executable when frozen
+    sys.exit(main())
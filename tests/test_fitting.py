@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from QCurveFinder.fitting import FitEngine, huber_coefficients, ransac_coefficients
+from QCurveFinder.models import SplineModel
+from QCurveFinder.tools import PointSet
+from QCurveFinder.constants import *
+
+
+@pytest.fixture
+def outliers():
+    x = np.linspace(0, 100, 1000)
+    y = x**2
+    noisy = y.copy()
+    noisy[::10] += 2000
+    return x, y, noisy
+
+
+@pytest.mark.parametrize("robust", [huber_coefficients, ransac_coefficients])
+def test_robust_fits_ignore_outliers(outliers, robust):
+    x, y, noisy = outliers
+    assert np.abs(np.polyval(robust(x, noisy, 2), x) - y).max() < 1
+
+
+def test_spline_without_valid_knots_raises():
+    with pytest.raises(ValueError):
+        SplineModel.fit(np.array([0, 1, 2, 3, 4, np.nan]), np.arange(6.))
+
+
+@pytest.mark.parametrize("model_type", POLYNOMIAL_MODELS)
+def test_polynomial_models_report_their_type(outliers, model_type):
+    x, _, noisy = outliers
+    model = FitEngine(PointSet(np.column_stack((x, noisy)))).model(model_type, 2)
+    assert model.name == model_type.name.lower()
+    assert model.to_dict()["model"] == model_type.name.lower()
@@ -0,0 +1,46 @@
+import tracemalloc
+import numpy as np
+import pytest
+import cv2
+import os
+from QCurveFinder.engine import FilterSpec, contour_mask
+from QCurveFinder.pipeline import read_image
+from QCurveFinder.tiles import TiledProcessor
+from QCurveFinder.constants import *
+
+
+@pytest.fixture(scope="module", params=["placeholder.png", "originalGraph.png"])
+def image(request) -> np.ndarray:
+    return read_image(os.path.join(RESOURCES_PATH, request.param))
+
+
+@pytest.mark.parametrize("contour", list(ContourOptions))
+@pytest.mark.parametrize("tile_size", [64, 200])
+def test_tiled_contours_match_whole_image(image, contour, tile_size):
+    tr1, tr2 = (100, 200) if contour == ContourOptions.CANNY else (100, 255)
+    spec = FilterSpec(FilterMode.CONTOURS, contour, tr1, tr2)
+    tiles = TiledProcessor(tile_size)
+
+    whole = contour_mask(image, spec)
+    np.testing.assert_array_equal(tiles.contour_mask(image, spec), whole)
+
+    count = cv2.connectedComponents((whole > 0).astype(np.uint8), connectivity=8)[0] - 1
+    assert tiles.contour_labels(image, spec).max() == count
+
+
+def test_tiled_colors_match_whole_image(image):
+    spec = FilterSpec(FilterMode.COLORS, color=(0, 0, 0), thresh=60)
+    np.testing.assert_array_equal(TiledProcessor(64).contour_mask(image, spec), contour_mask(image, spec))
+
+
+def test_tiled_canny_memory_is_bounded():
+    # The hysteresis is done tile by tile: only the uint8 edges and mask are full-frame, not int32 labels
+    img = cv2.resize(read_image(os.path.join(RESOURCES_PATH, "originalGraph.png")), (3000, 2000))
+    spec = FilterSpec(FilterMode.CONTOURS, ContourOptions.CANNY, 100, 200)
+    tracemalloc.start()
+    try:
+        TiledProcessor(256).contour_mask(img, spec)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 4*img.shape[0]*img.shape[1]